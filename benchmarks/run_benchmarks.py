@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for kiltsreader on synthetic Kilts-format data.
+
+Generates data with benchmarks/synthetic.py (or reuses the data already
+in --data, in which case --scale and --years are not applied), then times
+each reader stage, from discovery (the constructor) to write_data, on the
+extracted trees and, with --tgz, on the .tgz archives. Every pipeline run
+happens in a fresh process, so memory figures do not carry over from one
+pipeline to the next. For every stage it records wall time (the fastest
+of --repeat runs) and memory:
+    seconds         wall time of the stage
+    arrow_bytes     Arrow memory held after the stage
+    arrow_peak      peak Arrow memory while the stage ran (sampled, as in
+                    the readers' own stats)
+    max_rss         peak resident set size of the pipeline's process
+                    at the end of the stage
+    rss_growth      how much the stage raised max_rss
+
+Results are written as JSON (--out). Pass --baseline to compare against
+an earlier run; stages slower than the baseline, or with a larger
+arrow_peak, by more than --tolerance are flagged, and --check makes the
+script exit with status 1 if any are.
+Save a baseline once with --out benchmarks/baseline.json and compare
+later runs of the same machine against it.
+
+Usage:
+    python benchmarks/run_benchmarks.py --scale 4 --tgz --out results.json
+    python benchmarks/run_benchmarks.py --scale 4 --baseline results.json --check
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import platform
+import sys
+import tempfile
+import pathlib as path
+from concurrent.futures import ProcessPoolExecutor
+
+import pyarrow as pa
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+sys.path.insert(0, str(path.Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(path.Path(__file__).resolve().parent))
+
+import kiltsreader
+from kiltsreader import RetailReader, PanelReader, ReaderStats
+import synthetic
+
+
+def max_rss():
+    """Peak resident set size of this process in bytes (None if unknown)."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def retail_stages(dir_read, dir_write):
+    """(name, function) pairs for a RetailReader pipeline."""
+    state = {}
+    def init():
+        state['rr'] = RetailReader(dir_read, verbose = False)
+    return [('init', init),
+            ('read_stores', lambda: state['rr'].read_stores()),
+            ('read_products', lambda: state['rr'].read_products()),
+            ('read_rms', lambda: state['rr'].read_rms()),
+            ('read_sales', lambda: state['rr'].read_sales(add_dates = True)),
+            ('write_data', lambda: state['rr'].write_data(dir_write, stub = 'bench'))]
+
+
+def panel_stages(dir_read, dir_write):
+    """(name, function) pairs for a PanelReader pipeline."""
+    state = {}
+    def init():
+        state['pr'] = PanelReader(dir_read, verbose = False)
+    return [('init', init),
+            ('read_products', lambda: state['pr'].read_products()),
+            ('read_retailers', lambda: state['pr'].read_retailers()),
+            ('read_annual', lambda: state['pr'].read_annual(add_trip_info = True,
+                                                             add_dates = True)),
+            ('aggregate_purchases', lambda: state['pr'].aggregate_purchases(
+                by = ['product_module_code'], period = 'month')),
+            ('write_data', lambda: state['pr'].write_data(dir_write, stub = 'bench'))]
+
+
+def run_pipeline(stages, verbose = False):
+    """Run the stages in order and return {stage: measurements}."""
+    stats = ReaderStats()
+    results = {}
+    for name, func in stages:
+        sink = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        rss_before = max_rss()
+        with sink, stats.span(name):
+            func()
+        span = stats.spans[-1]
+        rss_after = max_rss()
+        results[name] = {'seconds': span['seconds'],
+                         'arrow_bytes': span['arrow_bytes'],
+                         'arrow_peak': span['arrow_peak'],
+                         'max_rss': rss_after,
+                         'rss_growth': None if rss_after is None else rss_after - rss_before}
+    return results
+
+
+def run_isolated(make_stages, dir_read, dir_write, verbose = False):
+    """Run one pipeline in a fresh process and return its measurements."""
+    # spawn rather than fork: a forked child starts with the parent's peak RSS
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers = 1, mp_context = context) as pool:
+        return pool.submit(_run_stages, make_stages, dir_read, dir_write, verbose).result()
+
+
+def _run_stages(make_stages, dir_read, dir_write, verbose):
+    return run_pipeline(make_stages(dir_read, dir_write), verbose)
+
+
+def run(dirs, dir_write, repeat = 1, verbose = False):
+    """
+    Time every pipeline on every source in dirs, each run in its own
+    process. Returns {'retail/dir/read_sales': {...}, ...} keeping the
+    fastest run per stage.
+    """
+    pipelines = {'retail/dir': (retail_stages, dirs['RMS']),
+                 'panel/dir': (panel_stages, dirs['HMS'])}
+    if 'RMS_tgz' in dirs:
+        pipelines['retail/tgz'] = (retail_stages, dirs['RMS_tgz'])
+        pipelines['panel/tgz'] = (panel_stages, dirs['HMS_tgz'])
+
+    results = {}
+    for label, (make_stages, dir_read) in pipelines.items():
+        for _ in range(repeat):
+            measurements = run_isolated(make_stages, dir_read, dir_write, verbose)
+            for stage, measured in measurements.items():
+                key = '{l}/{s}'.format(l=label, s=stage)
+                if key not in results or measured['seconds'] < results[key]['seconds']:
+                    results[key] = measured
+        print('{l}: {t:.2f}s'.format(
+            l=label, t=sum(v['seconds'] for k, v in results.items() if k.startswith(label + '/'))))
+    return results
+
+
+def compare(results, baseline, tolerance = 0.25, min_seconds = 0.05, min_bytes = 1 << 20):
+    """
+    Print each stage against the baseline and return the stages that are
+    more than tolerance (and min_seconds) slower, or whose arrow_peak is
+    more than tolerance (and min_bytes) larger.
+    """
+    regressions = []
+    print('{:<40} {:>10} {:>10} {:>8} {:>10} {:>10}'.format(
+        'stage', 'baseline', 'now', 'ratio', 'peak MB', 'now MB'))
+    for key, measured in results.items():
+        if key not in baseline:
+            print('{:<40} {:>10} {:>10.3f}'.format(key, '-', measured['seconds']))
+            continue
+        base = baseline[key]['seconds']
+        now = measured['seconds']
+        ratio = now / base if base > 0 else float('inf')
+        flags = []
+        if now > base * (1 + tolerance) and now - base > min_seconds:
+            flags.append('SLOWER')
+        base_peak = baseline[key].get('arrow_peak') or 0
+        now_peak = measured['arrow_peak']
+        if now_peak > base_peak * (1 + tolerance) and now_peak - base_peak > min_bytes:
+            flags.append('MORE MEMORY')
+        if flags:
+            regressions.append(key)
+        print('{:<40} {:>10.3f} {:>10.3f} {:>8.2f} {:>10.1f} {:>10.1f}{f}'.format(
+            key, base, now, ratio, base_peak / 1e6, now_peak / 1e6,
+            f=''.join('  ' + flag for flag in flags)))
+    return regressions
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark kiltsreader on synthetic data')
+    parser.add_argument('--data', help = 'synthetic data root, generated there if missing '
+                                         '(default: a temporary directory)')
+    parser.add_argument('--scale', type = float, default = 1.0)
+    parser.add_argument('--years', type = int, nargs = '+', default = [2010, 2011])
+    parser.add_argument('--tgz', action = 'store_true', help = 'also benchmark reading .tgz archives')
+    parser.add_argument('--repeat', type = int, default = 1)
+    parser.add_argument('--out', help = 'write results to this JSON file')
+    parser.add_argument('--baseline', help = 'JSON results to compare against')
+    parser.add_argument('--tolerance', type = float, default = 0.25)
+    parser.add_argument('--check', action = 'store_true',
+                        help = 'exit with status 1 on regressions against the baseline')
+    parser.add_argument('--verbose', action = 'store_true', help = 'show reader output')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as dir_tmp:
+        dir_tmp = path.Path(dir_tmp)
+        root = path.Path(args.data) if args.data else dir_tmp / 'data'
+        dirs = synthetic.existing(root)
+        if 'RMS' in dirs and 'HMS' in dirs and (not args.tgz or 'RMS_tgz' in dirs):
+            print('Using synthetic data in', root)
+        else:
+            print('Generating synthetic data in', root)
+            dirs = synthetic.generate(root, args.scale, args.years, args.tgz)
+        if not args.tgz:
+            dirs = {k: v for k, v in dirs.items() if not k.endswith('_tgz')}
+        dir_write = dir_tmp / 'out'
+        dir_write.mkdir()
+        results = run(dirs, dir_write, args.repeat, args.verbose)
+
+    report = {'meta': {'scale': args.scale, 'years': args.years, 'repeat': args.repeat,
+                       'kiltsreader': kiltsreader.__version__, 'pyarrow': pa.__version__,
+                       'python': platform.python_version(), 'platform': platform.platform(),
+                       'cpu_count': pa.cpu_count()},
+              'results': results}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent = 2)
+        print('Wrote results to', args.out)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['meta'].get('scale') != args.scale:
+            print('Warning: baseline was run at scale', baseline['meta'].get('scale'))
+        regressions = compare(results, baseline['results'], args.tolerance)
+        if regressions and args.check:
+            print('{n} stage(s) regressed'.format(n=len(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic Kilts-format data for benchmarking kiltsreader.
+
+The licensed NielsenIQ files cannot be shared, so this writes trees with
+the same layout, file names and columns as the Kilts downloads:
+
+    [root]/nielsen_extracts/RMS/Master_Files/Latest/products.tsv
+    [root]/nielsen_extracts/RMS/[year]/Annual_Files/stores_[year].tsv
+                                                   rms_versions_[year].tsv
+                                                   products_extra_[year].tsv
+    [root]/nielsen_extracts/RMS/[year]/Movement_Files/[group]_[year]/[module]_[year].tsv
+
+    [root]/nielsen_extracts/HMS/Master_Files/Latest/products.tsv
+                                                    brand_variations.tsv
+                                                    retailers.tsv
+    [root]/nielsen_extracts/HMS/[year]/Annual_Files/panelists_[year].tsv
+                                                   trips_[year].tsv
+                                                   purchases_[year].tsv
+
+and optionally the same trees packed into .tgz archives under
+[root]/tgz/RMS and [root]/tgz/HMS (one archive per year plus one for the
+master files), which the readers open without extracting.
+
+Cardinalities (stores, UPCs per module, households, ...) are multiplied
+by a scale factor. Values follow the rough shape of the real data:
+prices ending in .x9, sparse store x UPC x week coverage, reused UPCs with
+a second version in later years, and occasional missing feature/display.
+
+Usage:
+    python benchmarks/synthetic.py /tmp/kilts --scale 2 --tgz
+"""
+
+import argparse
+import datetime as dt
+import tarfile
+import pathlib as path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv
+
+
+def write_tsv(table, filename):
+    """Write a table as a Kilts-style TSV: tab separated, header, no quotes."""
+    filename.parent.mkdir(parents = True, exist_ok = True)
+    csv.write_csv(table, filename,
+                  csv.WriteOptions(delimiter = '\t', quoting_style = 'none'))
+    return filename
+
+
+def scanner_weeks(year):
+    """Saturdays ending the scanner weeks of a year, as YYYYMMDD integers."""
+    day = dt.date(year, 1, 1)
+    day += dt.timedelta(days = (5 - day.weekday()) % 7)
+    weeks = []
+    while day.year == year:
+        weeks.append(int(day.strftime('%Y%m%d')))
+        day += dt.timedelta(days = 7)
+    return np.array(weeks)
+
+
+def _prices(rng, n):
+    """Shelf prices like 1.29, 3.49, 4.99."""
+    return np.round(rng.integers(0, 8, n) + rng.choice([0.29, 0.49, 0.79, 0.99], n), 2)
+
+
+def make_products(n_groups = 1, modules_per_group = 2, upcs_per_module = 40,
+                  reused_share = 0.1, seed = 0):
+    """
+    Master products table. UPCs in the reused share have a second version
+    (upc_ver_uc = 2) that rms_versions assigns from the second year on.
+    """
+    rng = np.random.default_rng(seed)
+    groups = 1500 + np.arange(n_groups)
+    modules = np.array([1000 + 10 * g + m for g in range(n_groups)
+                        for m in range(modules_per_group)])
+    module_group = np.repeat(groups, modules_per_group)
+
+    n = len(modules) * upcs_per_module
+    upc = 10000000000 + np.arange(n, dtype = np.int64)
+    module = np.repeat(modules, upcs_per_module)
+    group = np.repeat(module_group, upcs_per_module)
+    brand = rng.integers(0, max(upcs_per_module // 4, 1), n) + 100 * (module % 1000)
+
+    reused = rng.random(n) < reused_share
+    upc = np.concatenate([upc, upc[reused]])
+    ver = np.concatenate([np.ones(n, np.int64), np.full(reused.sum(), 2)])
+    module = np.concatenate([module, module[reused]])
+    group = np.concatenate([group, group[reused]])
+    brand = np.concatenate([brand, brand[reused]])
+    m = len(upc)
+
+    return pa.table({
+        'upc': upc,
+        'upc_ver_uc': ver,
+        'upc_descr': pa.array(['ITEM {u}'.format(u=u) for u in upc]),
+        'product_module_code': module,
+        'product_module_descr': pa.array(['MODULE {x}'.format(x=x) for x in module]),
+        'product_group_code': group,
+        'product_group_descr': pa.array(['GROUP {x}'.format(x=x) for x in group]),
+        'department_code': np.full(m, 1),
+        'department_descr': pa.array(['DRY GROCERY'] * m),
+        'brand_code_uc': brand,
+        'brand_descr': pa.array(['BRAND {b}'.format(b=b) for b in brand]),
+        'multi': np.ones(m, np.int64),
+        'size1_code_uc': rng.integers(1, 5, m),
+        'size1_amount': np.round(rng.choice([8.0, 12.0, 16.0, 32.0], m), 1),
+        'size1_units': pa.array(rng.choice(['OZ', 'CT', 'QT'], m)),
+        'dataset_found_uc': pa.array(['ALL'] * m),
+        'size1_change_flag_uc': np.zeros(m, np.int64),
+    })
+
+
+def generate_retail(root, years = (2010, 2011), scale = 1.0, n_stores = 50,
+                    n_groups = 1, modules_per_group = 2, upcs_per_module = 40,
+                    coverage = 0.5, seed = 0):
+    """
+    Function: writes a synthetic Retail Scanner tree under
+    [root]/nielsen_extracts/RMS
+    Arguments:
+        years: panel years to write
+        scale: multiplies n_stores and upcs_per_module
+        n_stores, n_groups, modules_per_group, upcs_per_module: cardinalities
+        coverage: share of store x UPC x week cells with sales
+        seed: random seed
+    Returns the RMS directory (pass it to RetailReader).
+    """
+    rng = np.random.default_rng(seed)
+    dir_rms = path.Path(root) / 'nielsen_extracts' / 'RMS'
+    n_stores = max(int(n_stores * scale), 1)
+    upcs_per_module = max(int(upcs_per_module * scale), 1)
+
+    products = make_products(n_groups, modules_per_group, upcs_per_module, seed = seed)
+    write_tsv(products, dir_rms / 'Master_Files' / 'Latest' / 'products.tsv')
+    first = products.filter(pc.equal(products['upc_ver_uc'], 1))
+    reused = set(products.filter(pc.equal(products['upc_ver_uc'], 2))['upc'].to_pylist())
+
+    stores = np.arange(1, n_stores + 1) * 7 + 1000
+    for i, year in enumerate(years):
+        dir_annual = dir_rms / str(year) / 'Annual_Files'
+        write_tsv(pa.table({
+            'store_code_uc': stores,
+            'year': np.full(n_stores, year),
+            'parent_code': stores % 11,
+            'retailer_code': stores % 37,
+            'channel_code': pa.array(rng.choice(['F', 'D', 'M'], n_stores, p = [0.6, 0.3, 0.1])),
+            'store_zip3': rng.integers(100, 999, n_stores),
+            'fips_state_code': stores % 50 + 1,
+            'fips_state_descr': pa.array(['S{x}'.format(x=x) for x in stores % 50 + 1]),
+            'fips_county_code': stores % 300 + 1,
+            'fips_county_descr': pa.array(['COUNTY {x}'.format(x=x) for x in stores % 300 + 1]),
+            'dma_code': 500 + stores % 40,
+            'dma_descr': pa.array(['DMA {x}'.format(x=x) for x in 500 + stores % 40]),
+        }), dir_annual / 'stores_{y}.tsv'.format(y=year))
+
+        upc = first['upc'].to_numpy()
+        ver = np.array([2 if (i > 0 and u in reused) else 1 for u in upc])
+        write_tsv(pa.table({'upc': upc, 'upc_ver_uc': ver, 'panel_year': np.full(len(upc), year)}),
+                  dir_annual / 'rms_versions_{y}.tsv'.format(y=year))
+
+        n_extra = len(upc) // 2
+        write_tsv(pa.table({'upc': upc[:n_extra], 'upc_ver_uc': ver[:n_extra],
+                            'panel_year': np.full(n_extra, year),
+                            'flavor_code': rng.integers(1, 20, n_extra),
+                            'flavor_descr': pa.array(['FLAVOR'] * n_extra)}),
+                  dir_annual / 'products_extra_{y}.tsv'.format(y=year))
+
+        weeks = scanner_weeks(year)
+        modules = sorted(set(zip(first['product_group_code'].to_pylist(),
+                                 first['product_module_code'].to_pylist())))
+        for group, module in modules:
+            module_upc = upc[first['product_module_code'].to_numpy() == module]
+            cells = np.stack(np.meshgrid(stores, module_upc, weeks, indexing = 'ij'), -1).reshape(-1, 3)
+            cells = cells[rng.random(len(cells)) < coverage]
+            n = len(cells)
+            feature = pa.array(rng.choice([0, 1], n, p = [0.9, 0.1]), mask = rng.random(n) < 0.05)
+            display = pa.array(rng.choice([0, 1], n, p = [0.85, 0.15]), mask = rng.random(n) < 0.05)
+            write_tsv(pa.table({'store_code_uc': cells[:, 0],
+                                'upc': cells[:, 1],
+                                'week_end': cells[:, 2],
+                                'units': rng.geometric(0.15, n),
+                                'prmult': np.where(rng.random(n) < 0.05, 2, 1),
+                                'price': _prices(rng, n),
+                                'feature': feature,
+                                'display': display}),
+                      dir_rms / str(year) / 'Movement_Files' / '{g}_{y}'.format(g=group, y=year)
+                      / '{m}_{y}.tsv'.format(m=module, y=year))
+    return dir_rms
+
+
+def _births(rng, n, mask = None):
+    """Birth months like 1962-01, null where mask is set."""
+    return pa.array(['{y}-{m:02d}'.format(y=y, m=m) for y, m in
+                     zip(rng.integers(1930, 2010, n), rng.integers(1, 13, n))], mask = mask)
+
+
+def make_panelists(rng, households, states, year):
+    """One year of the panelists file with the full Kilts column set."""
+    n = len(households)
+    size = rng.integers(1, 8, n)
+    columns = {
+        'Household_Cd': households,
+        'Panel_Year': np.full(n, year),
+        'Projection_Factor': np.round(rng.gamma(4.0, 5000.0, n), 2),
+        'Projection_Factor_Magnet': np.round(rng.gamma(4.0, 5000.0, n), 2),
+        'Household_Income': rng.integers(3, 28, n),
+        'Household_Size': size,
+        'Type_Of_Residence': rng.integers(1, 8, n),
+        'Household_Composition': rng.integers(1, 9, n),
+        'Age_And_Presence_Of_Children': rng.integers(1, 10, n),
+        'Male_Head_Age': rng.integers(0, 10, n),
+        'Female_Head_Age': rng.integers(0, 10, n),
+        'Male_Head_Employment': rng.integers(0, 10, n),
+        'Female_Head_Employment': rng.integers(0, 10, n),
+        'Male_Head_Education': rng.integers(0, 7, n),
+        'Female_Head_Education': rng.integers(0, 7, n),
+        'Male_Head_Occupation': rng.integers(0, 13, n),
+        'Female_Head_Occupation': rng.integers(0, 13, n),
+        'Male_Head_Birth': _births(rng, n),
+        'Female_Head_Birth': _births(rng, n),
+        'Marital_Status': rng.integers(1, 6, n),
+        'Race': rng.integers(1, 5, n),
+        'Hispanic_Origin': rng.integers(1, 3, n),
+        'Panelist_ZipCd': rng.integers(1000, 99999, n),
+        'Fips_State_Cd': households % 50 + 1,
+        'Fips_State_Desc': pa.array(states),
+        'Fips_County_Cd': households % 300 + 1,
+        'Fips_County_Desc': pa.array(['COUNTY {x}'.format(x=x) for x in households % 300 + 1]),
+        'Region_Cd': rng.integers(1, 5, n),
+        'Scantrack_Market_Identifier_Cd': households % 60 + 1,
+        'Scantrack_Market_Identifier_Desc': pa.array(['MARKET {x}'.format(x=x) for x in households % 60 + 1]),
+        'DMA_Cd': 500 + households % 40,
+        'DMA_Name': pa.array(['DMA {x}'.format(x=x) for x in 500 + households % 40]),
+        'Kitchen_Appliances': rng.integers(0, 8, n),
+        'TV_Items': rng.integers(0, 8, n),
+        'Household_Internet_Connection': rng.integers(0, 2, n),
+        'Wic_Indicator_Current': rng.integers(0, 2, n),
+        'Wic_Indicator_Ever_Not_Current': rng.integers(0, 2, n),
+    }
+    for k in range(1, 8):
+        absent = size < k
+        columns['Member_{k}_Birth'.format(k=k)] = _births(rng, n, absent)
+        columns['Member_{k}_Relationship_Sex'.format(k=k)] = pa.array(rng.integers(1, 9, n), mask = absent)
+        columns['Member_{k}_Employment'.format(k=k)] = pa.array(rng.integers(0, 10, n), mask = absent)
+    return pa.table(columns)
+
+
+def generate_panel(root, years = (2010, 2011), scale = 1.0, n_households = 500,
+                   trips_per_household = 50, items_per_trip = 4, n_retailers = 40,
+                   n_groups = 1, modules_per_group = 2, upcs_per_module = 40, seed = 0):
+    """
+    Function: writes a synthetic Consumer Panel tree under
+    [root]/nielsen_extracts/HMS
+    Arguments:
+        years: panel years to write
+        scale: multiplies n_households and upcs_per_module
+        n_households, trips_per_household, items_per_trip, n_retailers,
+        n_groups, modules_per_group, upcs_per_module: cardinalities
+        seed: random seed
+    Returns the HMS directory (pass it to PanelReader).
+    """
+    rng = np.random.default_rng(seed + 1)
+    dir_hms = path.Path(root) / 'nielsen_extracts' / 'HMS'
+    n_households = max(int(n_households * scale), 1)
+    upcs_per_module = max(int(upcs_per_module * scale), 1)
+
+    products = make_products(n_groups, modules_per_group, upcs_per_module, seed = seed)
+    dir_master = dir_hms / 'Master_Files' / 'Latest'
+    write_tsv(products, dir_master / 'products.tsv')
+    brands = np.unique(products['brand_code_uc'].to_numpy())
+    write_tsv(pa.table({'brand_code_uc': brands,
+                        'brand_descr': pa.array(['BRAND {b}'.format(b=b) for b in brands]),
+                        'brand_descr_alternative': pa.array(['BRAND {b}'.format(b=b) for b in brands]),
+                        'start_date': pa.array(['2004-01-01'] * len(brands)),
+                        'end_date': pa.array(['2020-12-31'] * len(brands)),
+                        'datasets_found_uc': pa.array(['ALL'] * len(brands))}),
+              dir_master / 'brand_variations.tsv')
+    write_tsv(pa.table({'retailer_code': np.arange(n_retailers),
+                        'channel_type': pa.array(rng.choice(['Grocery', 'Discount Store', 'Drug Store'],
+                                                            n_retailers))}),
+              dir_master / 'retailers.tsv')
+
+    upc = products['upc'].to_numpy()
+    ver = products['upc_ver_uc'].to_numpy()
+    households = 2000000 + np.arange(n_households)
+    states = np.array(['CT', 'NY', 'NJ', 'RI', 'MA', 'IL', 'CA', 'TX'])
+    hh_state = rng.choice(states, n_households)
+    trip_code = 1
+    for year in years:
+        dir_annual = dir_hms / str(year) / 'Annual_Files'
+        write_tsv(make_panelists(rng, households, hh_state, year),
+                  dir_annual / 'panelists_{y}.tsv'.format(y=year))
+
+        n_trips = n_households * trips_per_household
+        trip = trip_code + np.arange(n_trips)
+        trip_code += n_trips
+        days = rng.integers(0, 365, n_trips)
+        dates = (np.datetime64('{y}-01-01'.format(y=year)) + days).astype(str)
+        write_tsv(pa.table({
+            'trip_code_uc': trip,
+            'household_code': np.repeat(households, trips_per_household),
+            'purchase_date': pa.array(dates),
+            'retailer_code': rng.integers(0, n_retailers, n_trips),
+            'store_code_uc': np.where(rng.random(n_trips) < 0.3, 0, rng.integers(1, 5000, n_trips)),
+            'panel_year': np.full(n_trips, year),
+            'store_zip3': rng.integers(100, 999, n_trips),
+            'total_spent': np.round(rng.gamma(2.0, 20.0, n_trips), 2),
+            'method_of_payment_cd': rng.integers(1, 8, n_trips),
+        }), dir_annual / 'trips_{y}.tsv'.format(y=year))
+
+        n_items = rng.poisson(items_per_trip, n_trips) + 1
+        pick = rng.integers(0, len(upc), n_items.sum())
+        quantity = rng.geometric(0.6, len(pick))
+        paid = np.round(_prices(rng, len(pick)) * quantity, 2)
+        coupon = np.where(rng.random(len(pick)) < 0.05, np.round(paid * 0.2, 2), 0.0)
+        write_tsv(pa.table({
+            'trip_code_uc': np.repeat(trip, n_items),
+            'upc': upc[pick],
+            'upc_ver_uc': ver[pick],
+            'quantity': quantity,
+            'total_price_paid': paid,
+            'coupon_value': coupon,
+            'deal_flag_uc': (rng.random(len(pick)) < 0.2).astype(np.int64),
+        }), dir_annual / 'purchases_{y}.tsv'.format(y=year))
+    return dir_hms
+
+
+def pack_tgz(dir_data, dir_tgz, prefix):
+    """
+    Pack a generated RMS or HMS tree into .tgz archives named like the
+    Kilts downloads: one per year plus one for Master_Files. Member names
+    keep the nielsen_extracts/... layout. Returns the archive directory.
+    """
+    dir_data = path.Path(dir_data)
+    dir_tgz = path.Path(dir_tgz)
+    dir_tgz.mkdir(parents = True, exist_ok = True)
+    base = dir_data.parent.parent
+    for child in sorted(dir_data.iterdir()):
+        name = '{p}_{c}.tgz'.format(p=prefix, c=child.name)
+        with tarfile.open(dir_tgz / name, 'w:gz') as tar:
+            tar.add(child, arcname = child.relative_to(base).as_posix())
+    return dir_tgz
+
+
+def generate(root, scale = 1.0, years = (2010, 2011), tgz = False, seed = 0):
+    """
+    Write both trees (and archives if tgz) under root.
+    Returns {'RMS': dir, 'HMS': dir} plus 'RMS_tgz' / 'HMS_tgz' if tgz.
+    """
+    root = path.Path(root)
+    dirs = {'RMS': generate_retail(root, years, scale, seed = seed),
+            'HMS': generate_panel(root, years, scale, seed = seed)}
+    if tgz:
+        # scanner archive names must not mention the panel, and vice versa
+        dirs['RMS_tgz'] = pack_tgz(dirs['RMS'], root / 'tgz' / 'RMS', 'Scanner_Data')
+        dirs['HMS_tgz'] = pack_tgz(dirs['HMS'], root / 'tgz' / 'HMS', 'Consumer_Panel_Data')
+    return dirs
+
+
+def existing(root):
+    """The directories of data generated earlier under root, in the form
+    returned by generate (empty if there is none)."""
+    root = path.Path(root)
+    dirs = {}
+    for kind in ('RMS', 'HMS'):
+        if (root / 'nielsen_extracts' / kind).is_dir():
+            dirs[kind] = root / 'nielsen_extracts' / kind
+        if (root / 'tgz' / kind).is_dir():
+            dirs[kind + '_tgz'] = root / 'tgz' / kind
+    return dirs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Write synthetic Kilts-format data')
+    parser.add_argument('root', help = 'output directory')
+    parser.add_argument('--scale', type = float, default = 1.0)
+    parser.add_argument('--years', type = int, nargs = '+', default = [2010, 2011])
+    parser.add_argument('--tgz', action = 'store_true', help = 'also write .tgz archives')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+    for kind, dir_out in generate(args.root, args.scale, args.years, args.tgz, args.seed).items():
+        print(kind, dir_out)
@@ -1,2 +1,2 @@
-from .module import RetailReader, PanelReader
+from .module import RetailReader, PanelReader, load_sales, load_panel, load_households, load_separated, benchmark_codecs, ReaderStats, ProgressReporter, SalesPlan
 __version__ = '0.0.1'
\ No newline at end of file
@@ -27,9 +27,18 @@ See Example.py for implementation of the RetailReader and PanelReader functions
 
 
 # %% Initial Methods and Packages
+import contextlib
+import copy
+import fnmatch
+import inspect
+import json
+import shutil
 import time
 import tarfile
+import tempfile
+import threading
 import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 import pyarrow as pa
@@ -40,23 +49,291 @@ from pyarrow import csv
 
 import pathlib as path
 
-_start_time = time.time()
-def tick():
+def _print_elapsed(seconds):
     """
-    Start Timer
+    Print Time Passed
     """
-    global _start_time 
-    _start_time = time.time()
-def tock():
-    """
-    Stop Timer and Print Time Passed
-    """
-    t_sec = round(time.time() - _start_time)
+    t_sec = round(seconds)
     (t_min, t_sec) = divmod(t_sec,60)
     (t_hour,t_min) = divmod(t_min,60) 
     print('Time passed: {}hour:{}min:{}sec'.format(t_hour,t_min,t_sec))
 
 
+class ReaderStats:
+    """
+    Timed spans and counters for one reader (RetailReader.stats,
+    PanelReader.stats).
+
+    Each span is a dict with the stage, the file it worked on, start (epoch
+    seconds), seconds, thread, arrow_bytes (pa.total_allocated_bytes() when
+    the span ended), arrow_peak (the most Arrow memory allocated while it
+    ran) and whichever counters the stage sets: bytes_read, rows_in,
+    rows_kept. The readers record the stages in STAGES; a file is usually
+    parsed, filtered, joined and cleaned in separate spans.
+
+    While a span is open, a background thread samples
+    pa.total_allocated_bytes() every sample_interval seconds for
+    arrow_peak (None: only at the start and end of each span).
+
+    Spans can be recorded from several threads at once. callback, if given,
+    is called with every finished span, e.g. to forward it to a log.
+    """
+
+    STAGES = ('discover', 'parse', 'filter', 'join', 'clean', 'write')
+    COUNTERS = ('bytes_read', 'rows_in', 'rows_kept')
+
+    def __init__(self, callback = None, sample_interval = 0.01):
+        self.callback = callback
+        self.sample_interval = sample_interval
+        self.spans = []
+        self._lock = threading.Lock()
+        self._open = {}  # token -> peak of each span in progress
+        self._sampler = None
+
+    def __getstate__(self):
+        # readers are pickled to process pool workers: locks, threads and
+        # callbacks (often lambdas) do not pickle
+        state = self.__dict__.copy()
+        for key in ('_lock', '_open', '_sampler'):
+            del state[key]
+        state['callback'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._open = {}
+        self._sampler = None
+
+    def record(self, stage, file = None, seconds = 0.0, start = None, **counters):
+        """Record a finished span that took seconds and return it."""
+        span = {'stage': stage,
+                'file': None if file is None else str(file),
+                'start': time.time() - seconds if start is None else start,
+                'seconds': seconds,
+                'thread': threading.current_thread().name,
+                'arrow_bytes': pa.total_allocated_bytes()}
+        span.update(counters)
+        span['arrow_peak'] = max(span.get('arrow_peak', 0), span['arrow_bytes'])
+        self.extend([span])
+        return span
+
+    def extend(self, spans):
+        """Add spans recorded elsewhere, e.g. in a worker process."""
+        with self._lock:
+            self.spans.extend(spans)
+        if self.callback is not None:
+            for span in spans:
+                self.callback(span)
+
+    @contextlib.contextmanager
+    def span(self, stage, file = None, **counters):
+        """
+        Time the with block as one span. Counters can be passed here or
+        set on the yielded dict inside the block.
+        """
+        counters = dict(counters)
+        token = object()
+        with self._lock:
+            self._open[token] = pa.total_allocated_bytes()
+            if self.sample_interval and self._sampler is None:
+                self._sampler = threading.Thread(target = self._sample, daemon = True)
+                self._sampler.start()
+        start = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield counters
+        finally:
+            with self._lock:
+                counters['arrow_peak'] = self._open.pop(token)
+            self.record(stage, file, time.perf_counter() - t0, start, **counters)
+
+    def _sample(self):
+        # sampler thread: raise the peak of every open span, and stop
+        # once none are left
+        while True:
+            with self._lock:
+                if not self._open:
+                    self._sampler = None
+                    return
+                allocated = pa.total_allocated_bytes()
+                for token, peak in self._open.items():
+                    self._open[token] = max(peak, allocated)
+            time.sleep(self.sample_interval)
+
+    def totals(self):
+        """
+        Return {stage: {'spans', 'seconds', 'bytes_read', 'rows_in',
+        'rows_kept', 'arrow_bytes', 'arrow_peak'}} summed over spans
+        (arrow_bytes and arrow_peak are the largest values seen).
+        """
+        with self._lock:
+            spans = list(self.spans)
+        totals = {}
+        for span in spans:
+            total = totals.setdefault(span['stage'], dict(
+                {'spans': 0, 'seconds': 0.0, 'arrow_bytes': 0, 'arrow_peak': 0},
+                **{c: 0 for c in self.COUNTERS}))
+            total['spans'] += 1
+            total['seconds'] += span['seconds']
+            total['arrow_bytes'] = max(total['arrow_bytes'], span['arrow_bytes'])
+            total['arrow_peak'] = max(total['arrow_peak'], span.get('arrow_peak', 0))
+            for c in self.COUNTERS:
+                total[c] += span.get(c) or 0
+        return totals
+
+    def to_dict(self):
+        """Return {'totals': totals(), 'spans': [...]}"""
+        with self._lock:
+            spans = [dict(span) for span in self.spans]
+        return {'totals': self.totals(), 'spans': spans}
+
+    def to_json(self, filename = None, indent = None):
+        """Return to_dict() as a JSON string; also write it to filename if given."""
+        text = json.dumps(self.to_dict(), indent = indent)
+        if filename is not None:
+            path.Path(filename).write_text(text)
+        return text
+
+    def reset(self):
+        """Drop all spans recorded so far."""
+        with self._lock:
+            self.spans = []
+
+    def file_rows(self, files):
+        """
+        Return (rows_in, rows_kept) for files from their latest parse and
+        filter spans; files without a filter span keep every row.
+        """
+        files = {str(f) for f in files}
+        parsed, kept = {}, {}
+        with self._lock:
+            for span in self.spans:
+                if span['file'] in files:
+                    if span['stage'] == 'parse':
+                        parsed[span['file']] = span.get('rows_in') or 0
+                    elif span['stage'] == 'filter':
+                        kept[span['file']] = span.get('rows_kept') or 0
+        return (sum(parsed.values()),
+                sum(kept.get(f, rows) for f, rows in parsed.items()))
+
+
+class ProgressReporter:
+    """
+    Reports the progress of a long read one unit at a time: a module-year
+    file in RetailReader.read_sales, a year in PanelReader.read_annual.
+
+    Each update is a dict with task, unit (the label just finished),
+    units_done, units_total, files_done, files_total, bytes_done,
+    bytes_total, elapsed, mb_per_s, rows_per_s, kept_ratio and eta
+    (seconds left at the current MB/s, from the file sizes found at
+    discovery).
+
+    Updates go to callback if given, else to logger.info (any logging
+    Logger), else are printed. min_interval (seconds) limits how often
+    updates are sent; the last unit of a task is always reported.
+    """
+
+    def __init__(self, callback = None, logger = None, min_interval = 0.0):
+        self.callback = callback
+        self.logger = logger
+        self.min_interval = min_interval
+        self.start('', {}, {})
+
+    def start(self, task, units, sizes, unit_name = 'units'):
+        """
+        Begin a task. units: {label: [files]} in reading order;
+        sizes: {file: bytes} (missing sizes count as 0).
+        """
+        self.task = task
+        self.unit_name = unit_name
+        self.units = {label: list(files) for label, files in units.items()}
+        self.unit_bytes = {label: sum(sizes.get(f) or 0 for f in files)
+                           for label, files in self.units.items()}
+        self.done = []
+        self.bytes_done = 0
+        self.rows_in = 0
+        self.rows_kept = 0
+        self._t0 = time.perf_counter()
+        self._last_sent = None
+
+    def advance(self, unit, rows_in = 0, rows_kept = 0):
+        """Mark a unit as finished and send an update."""
+        self.done.append(unit)
+        self.bytes_done += self.unit_bytes.get(unit, 0)
+        self.rows_in += rows_in
+        self.rows_kept += rows_kept
+
+        elapsed = time.perf_counter() - self._t0
+        bytes_total = sum(self.unit_bytes.values())
+        units_total = len(self.units)
+        if self.bytes_done > 0 and bytes_total > 0:
+            eta = elapsed * (bytes_total - self.bytes_done) / self.bytes_done
+        else:
+            eta = elapsed * (units_total - len(self.done)) / len(self.done)
+        update = {'task': self.task,
+                  'unit': unit,
+                  'unit_name': self.unit_name,
+                  'units_done': len(self.done),
+                  'units_total': units_total,
+                  'files_done': sum(len(self.units.get(u, ())) for u in self.done),
+                  'files_total': sum(len(f) for f in self.units.values()),
+                  'bytes_done': self.bytes_done,
+                  'bytes_total': bytes_total,
+                  'elapsed': elapsed,
+                  'mb_per_s': self.bytes_done / 1e6 / elapsed if elapsed > 0 else None,
+                  'rows_per_s': self.rows_in / elapsed if elapsed > 0 else None,
+                  'kept_ratio': self.rows_kept / self.rows_in if self.rows_in > 0 else None,
+                  'eta': max(eta, 0.0)}
+
+        now = time.perf_counter()
+        last = len(self.done) >= units_total
+        if (not last and self._last_sent is not None
+                and now - self._last_sent < self.min_interval):
+            return update
+        self._last_sent = now
+        if self.callback is not None:
+            self.callback(update)
+        elif self.logger is not None:
+            self.logger.info(self.format(update))
+        else:
+            print(self.format(update))
+        return update
+
+    @staticmethod
+    def format(update):
+        """One-line summary of an update."""
+        def aux_hms(seconds):
+            (t_min, t_sec) = divmod(round(seconds), 60)
+            (t_hour, t_min) = divmod(t_min, 60)
+            return '{}:{:02d}:{:02d}'.format(t_hour, t_min, t_sec)
+
+        parts = ['{task} {unit}: {ud}/{ut} {name}, {fd}/{ft} files'.format(
+            task=update['task'], unit=update['unit'], name=update['unit_name'],
+            ud=update['units_done'], ut=update['units_total'],
+            fd=update['files_done'], ft=update['files_total'])]
+        if update['mb_per_s'] is not None:
+            parts.append('{:.1f} MB/s'.format(update['mb_per_s']))
+            parts.append('{:,.0f} rows/s'.format(update['rows_per_s']))
+        if update['kept_ratio'] is not None:
+            parts.append('{:.1%} kept'.format(update['kept_ratio']))
+        parts.append('elapsed {}'.format(aux_hms(update['elapsed'])))
+        parts.append('ETA {}'.format(aux_hms(update['eta'])))
+        return ', '.join(parts)
+
+
+def _progress_reporter(progress, verbose):
+    """
+    Reader progress argument: a ProgressReporter, a callback for one, or
+    None (print updates if verbose, otherwise no reporting).
+    """
+    if isinstance(progress, ProgressReporter):
+        return progress
+    if callable(progress):
+        return ProgressReporter(callback = progress)
+    return ProgressReporter() if verbose else None
+
+
 # note: u is for "unsigned"
 # so it technically has twice as much space!
 dict_types = {'upc': pa.uint64(),
@@ -130,6 +407,14 @@ dict_types = {'upc': pa.uint64(),
               }
 
 
+# Purchase columns not in dict_types: pinned so that streaming reads,
+# which infer types from the first block only, match csv.read_csv
+dict_purchase_types = {'trip_code_uc': pa.int64(),
+                       'total_price_paid': pa.float64(),
+                       'coupon_value': pa.float64(),
+                       }
+
+
 # Column renames applied to panelist data
 # Extend this mapping if NielsenIQ changes column naming conventions
 COLUMN_RENAME_MAP = {'Household_Cd': 'household_code',
@@ -137,6 +422,14 @@ COLUMN_RENAME_MAP = {'Household_Cd': 'household_code',
 # Keep backward compat alias
 dict_column_map = COLUMN_RENAME_MAP
 
+# Key columns used to match rows of the Revised_Panelist_Files to the
+# tables they correct
+REVISION_KEYS = {'panelists': ['household_code', 'panel_year'],
+                 'products': ['upc', 'upc_ver_uc'],
+                 'variations': ['brand_code_uc', 'brand_descr'],
+                 'retailers': ['retailer_code'],
+                 }
+
 # Expected column sets for format validation
 # If NielsenIQ changes column names, update these sets and dict_types above
 EXPECTED_PRODUCT_COLS = {
@@ -248,6 +541,7 @@ class TgzFileManager:
             list(dir_read.glob('*.tgz')) + list(dir_read.glob('*/*.tgz'))
         ))
         self._archive_map = {}  # maps virtual Path -> (tgz_path, member_name)
+        self._sizes = {}  # maps virtual Path -> uncompressed member size
 
     @property
     def has_archives(self):
@@ -285,6 +579,7 @@ class TgzFileManager:
                         continue
                     virtual_path = self.dir_read / member.name
                     self._archive_map[virtual_path] = (tgz_path, member.name)
+                    self._sizes[virtual_path] = member.size
                     virtual_files.append(virtual_path)
         return virtual_files
 
@@ -302,24 +597,151 @@ class TgzFileManager:
         extracted._tar_ref = tar
         return extracted
 
+    def file_size(self, virtual_path):
+        """Uncompressed size of an archive member (None if not a member)."""
+        return self._sizes.get(virtual_path)
+
 
 def _is_master_files(name):
     """Check if a directory name is a Master_Files variant (e.g. Master_Files, Master_Files_2006-2020)."""
     return name == 'Master_Files' or name.startswith('Master_Files_')
 
 
+def _file_size(self, filepath):
+    """Size in bytes of a data file (uncompressed size for .tgz members)."""
+    if getattr(self, '_tgz_manager', None) is not None:
+        size = self._tgz_manager.file_size(filepath)
+        if size is not None:
+            return size
+    try:
+        return path.Path(filepath).stat().st_size
+    except OSError:
+        return None
+
+
 def _read_csv(self, filepath, **kwargs):
     """Read a CSV/TSV file, transparently handling .tgz archive members.
     Falls back to standard csv.read_csv for normal file paths.
+    Recorded as a parse span in self.stats.
+    """
+    with self.stats.span('parse', filepath, bytes_read = _file_size(self, filepath)) as span:
+        file_obj = None
+        if hasattr(self, '_tgz_manager') and self._tgz_manager is not None:
+            file_obj = self._tgz_manager.open_file(filepath)
+        try:
+            if file_obj is not None:
+                table = csv.read_csv(pa.PythonFile(file_obj), **kwargs)
+            else:
+                table = csv.read_csv(filepath, **kwargs)
+        finally:
+            if file_obj is not None:
+                file_obj.close()
+        span['rows_in'] = table.num_rows
+    return table
+
+
+def _scan_csv(self, filepath, batch_filter=None, **kwargs):
+    """Stream a CSV/TSV file block by block with csv.open_csv, keeping only
+    the rows selected by batch_filter (a function from a RecordBatch to a
+    boolean mask). Peak memory is bounded by the kept rows plus one block.
+    Handles .tgz archive members like _read_csv.
+    Recorded as a parse span and, with batch_filter, a filter span holding
+    the time spent filtering blocks.
     """
+    start = time.time()
+    t0 = time.perf_counter()
+    filter_seconds = 0.0
+    rows_in = 0
+    # kept rows only grow: the peak is reached with some block in memory
+    arrow_peak = pa.total_allocated_bytes()
+    file_obj = None
     if hasattr(self, '_tgz_manager') and self._tgz_manager is not None:
         file_obj = self._tgz_manager.open_file(filepath)
+    source = pa.PythonFile(file_obj) if file_obj is not None else str(filepath)
+    try:
+        reader = csv.open_csv(source, **kwargs)
+        batches = []
+        for batch in reader:
+            rows_in += batch.num_rows
+            arrow_peak = max(arrow_peak, pa.total_allocated_bytes())
+            if batch_filter is not None:
+                t_filter = time.perf_counter()
+                batch = batch.filter(batch_filter(batch))
+                filter_seconds += time.perf_counter() - t_filter
+            if batch.num_rows > 0:
+                batches.append(batch)
+        table = pa.Table.from_batches(batches, schema = reader.schema)
+    finally:
         if file_obj is not None:
-            try:
-                return csv.read_csv(pa.PythonFile(file_obj), **kwargs)
-            finally:
-                file_obj.close()
-    return csv.read_csv(filepath, **kwargs)
+            file_obj.close()
+
+    self.stats.record('parse', filepath, time.perf_counter() - t0 - filter_seconds, start,
+                      bytes_read = _file_size(self, filepath), rows_in = rows_in,
+                      arrow_peak = arrow_peak)
+    if batch_filter is not None:
+        self.stats.record('filter', filepath, filter_seconds,
+                          rows_in = rows_in, rows_kept = table.num_rows)
+    return table
+
+
+def _sample_csv(self, filepath, sample_bytes, **kwargs):
+    """Parse the first sample_bytes of a CSV/TSV file, cut back to the last
+    full line (the whole file if it is smaller). Handles .tgz archive
+    members like _read_csv. Returns (table, bytes parsed, seconds).
+    """
+    file_obj = None
+    if getattr(self, '_tgz_manager', None) is not None:
+        file_obj = self._tgz_manager.open_file(filepath)
+    if file_obj is None:
+        file_obj = open(filepath, 'rb')
+    try:
+        data = file_obj.read(sample_bytes)
+    finally:
+        file_obj.close()
+    if len(data) == sample_bytes:
+        data = data[:data.rfind(b'\n') + 1]
+    t0 = time.perf_counter()
+    table = csv.read_csv(pa.BufferReader(data), **kwargs)
+    return table, len(data), time.perf_counter() - t0
+
+
+def _spread(items, n):
+    """Up to n items spread evenly over a list."""
+    items = list(items)
+    if len(items) <= n:
+        return items
+    return [items[i] for i in np.linspace(0, len(items) - 1, n).round().astype(int)]
+
+
+def _calibrated_rate(calibration):
+    """
+    Seconds per input byte over the parse, filter, join and clean stages
+    of an earlier run: a ReaderStats, its to_dict() or its totals().
+    None if it parsed no bytes.
+    """
+    if isinstance(calibration, ReaderStats):
+        totals = calibration.totals()
+    else:
+        totals = calibration.get('totals', calibration)
+    nbytes = totals.get('parse', {}).get('bytes_read', 0)
+    if not nbytes:
+        return None
+    seconds = sum(totals.get(stage, {}).get('seconds', 0.0)
+                  for stage in ('parse', 'filter', 'join', 'clean'))
+    return seconds / nbytes
+
+
+def _print_estimate(estimate):
+    """Print the totals of a RetailReader/PanelReader estimate."""
+    (t_min, t_sec) = divmod(round(estimate['seconds']), 60)
+    (t_hour, t_min) = divmod(t_min, 60)
+    print('Estimated {r:,.0f} rows from {f} files ({b:.1f} MB): '
+          '{a:.1f} MB of Arrow memory, peak {p:.1f} MB, '
+          'time {h}hour:{m}min:{s}sec{c}'.format(
+              r=estimate['rows'], f=estimate['files'], b=estimate['bytes'] / 1e6,
+              a=estimate['arrow_bytes'] / 1e6, p=estimate['arrow_peak'] / 1e6,
+              h=t_hour, m=t_min, s=t_sec,
+              c=' (calibrated)' if estimate['calibrated'] else ''))
 
 
 def _has_data_files(files):
@@ -391,6 +813,44 @@ def get_year(file, type = 'Sales'):
     return int(file.stem.split('_')[-1])
 
 
+def _birth_year(arr):
+    """Open-issue transform: 'YYYY-MM' birth dates to integer years, -1 if '-'."""
+    arr = pc.cast(arr, pa.string())
+    arr = pc.if_else(pc.equal(arr, '-'), pa.scalar(None, pa.string()), arr)
+    return pc.fill_null(pc.cast(pc.utf8_slice_codeunits(arr, 0, 4), pa.int64()), -1)
+
+
+# Declarative fixes for the NielsenIQ open issues, applied by
+# PanelReader.process_open_issues. Each spec gives:
+#   issue: folder name under OpenIssues_SupplementFiles
+#   target: PanelReader table to patch
+#   pattern: file name pattern within the issue folder
+#   keys: columns matching patch rows to target rows
+#   year: optional function of the file path giving its panel year;
+#         files outside the selected years are skipped, and panel_year
+#         is added to the patch if missing
+#   names: optional replacement column names for the patch files
+#   transforms: optional {column: function on an Arrow array}
+#   suffix: optional; write patched values to new column + suffix
+#           instead of overwriting
+OPEN_ISSUE_PATCHES = [
+    {'issue': 'ExtraAttributes_FlavorCode',
+     'target': 'df_extra',
+     'pattern': 'Latest_Flavor_*.csv',
+     'keys': ['upc', 'upc_ver_uc', 'panel_year'],
+     'year': get_year},
+    {'issue': 'Panelist_maleHeadBirth_femaleHeadBirth',
+     'target': 'df_panelists',
+     'keys': ['household_code', 'panel_year'],
+     'year': lambda f: 2000 + int(f.name[6:8]),
+     'names': ['household_code', 'panel_year',
+               'Male_Head_Birth', 'Female_Head_Birth'],
+     'transforms': {'Male_Head_Birth': _birth_year,
+                    'Female_Head_Birth': _birth_year},
+     'suffix': '_revised'},
+    ]
+
+
 # Read in the Products File
 # can limit to a subset of UPCs
 # but unfortunately, we will always have to read all the products
@@ -526,20 +986,1164 @@ def get_extra(self, years = None, upc_list = None):
 
     return
 
+
+def _composite_key(high, low, bits=16):
+    """Combine two integer arrays into uint64 keys (high << bits) | low."""
+    high = np.asarray(high, dtype=np.uint64)
+    low = np.asarray(low, dtype=np.uint64)
+    return (high << np.uint64(bits)) | low
+
+
+def _parse_dates(arr):
+    """Parse a 'YYYY-MM-DD' string (or already temporal) column to date32."""
+    if pa.types.is_dictionary(arr.type):
+        arr = arr.cast(arr.type.value_type)
+    if pa.types.is_string(arr.type) or pa.types.is_large_string(arr.type):
+        arr = pc.strptime(arr, format = '%Y-%m-%d', unit = 's')
+    return pc.cast(arr, pa.date32())
+
+
+def _calendar_columns(dates):
+    """Scanner calendar columns for a date or timestamp column.
+
+    Returns a dict of date32 arrays:
+        week_end: the Saturday ending the Nielsen scanner week of each date
+        month: first day of the month
+        quarter: last day of the quarter
+    Computed by building the lookup once for each day in the range of
+    dates and taking from it, rather than per row.
+    """
+    days = pc.cast(pc.cast(dates, pa.date32()), pa.int32())
+    if isinstance(days, pa.ChunkedArray):
+        days = days.combine_chunks()
+    valid = pc.is_valid(days).to_numpy(zero_copy_only=False)
+    day_values = pc.fill_null(days, 0).to_numpy()
+    if not valid.any():
+        return {c: pa.nulls(len(days), pa.date32()) for c in ('week_end', 'month', 'quarter')}
+
+    # lookup tables over every day in range
+    first = int(day_values[valid].min())
+    all_days = np.arange(first, int(day_values[valid].max()) + 1)
+    # 1970-01-01 (day 0) was a Thursday: (day + 4) % 7 counts from Sunday
+    week_end = all_days + (6 - (all_days + 4) % 7)
+    months = all_days.astype('datetime64[D]').astype('datetime64[M]')
+    month = months.astype('datetime64[D]').astype(np.int64)
+    month_num = months.astype(np.int64)
+    quarter = ((month_num - month_num % 3 + 3).astype('datetime64[M]')
+               .astype('datetime64[D]').astype(np.int64) - 1)
+
+    pos = np.where(valid, day_values - first, 0)
+    return {name: pa.array(table[pos].astype(np.int32), pa.int32(),
+                           mask = ~valid).cast(pa.date32())
+            for name, table in [('week_end', week_end), ('month', month),
+                                ('quarter', quarter)]}
+
+
+def _sales_read_columns(incl_promo = True):
+    """Movement file columns read by RetailReader.read_sales."""
+    my_cols = ['store_code_uc', 'upc', 'week_end', 'units', 'prmult', 'price']
+    if incl_promo == True:
+        my_cols = my_cols + ['feature', 'display']
+    return my_cols
+
+
+# store columns read_sales joins onto sales
+SALES_STORE_COLUMNS = ['dma_code', 'retailer_code', 'parent_code']
+
+# Movement file columns each derived read_sales column is built from
+SALES_COLUMN_SOURCES = {'unit_price': ('price', 'prmult'),
+                        'revenue': ('units', 'price', 'prmult'),
+                        'panel_year': ('week_end',),
+                        'upc_ver_uc': ('upc', 'week_end'),
+                        'dma_code': ('store_code_uc', 'week_end'),
+                        'retailer_code': ('store_code_uc', 'week_end'),
+                        'parent_code': ('store_code_uc', 'week_end'),
+                        'quarter': ('week_end',),
+                        'month': ('week_end',)}
+
+
+def _sales_output_columns(incl_promo = True, add_dates = False):
+    """Columns of df_sales after RetailReader.read_sales."""
+    my_cols = (_sales_read_columns(incl_promo)
+               + ['unit_price', 'panel_year', 'revenue', 'upc_ver_uc'] + SALES_STORE_COLUMNS)
+    if add_dates:
+        my_cols = my_cols + ['quarter', 'month']
+    return my_cols
+
+
+def _panelist_filter(keep_states = None, drop_states = None,
+                     keep_dmas = None, drop_dmas = None):
+    """Dataset expression selecting the panelists read by read_year."""
+    panelist_filter = pads.field('Projection_Factor') > 0
+
+    if keep_states:
+        panelist_filter = panelist_filter & (pads.field('Fips_State_Desc'
+                                                        ).isin(keep_states))
+    if drop_states:
+        panelist_filter = panelist_filter & (~pads.field('Fips_State_Desc'
+                                                         ).isin(drop_states))
+    if keep_dmas:
+        panelist_filter = panelist_filter & (pads.field('DMA_Cd').isin(keep_dmas))
+
+    if drop_dmas:
+        panelist_filter = panelist_filter & (~pads.field('DMA_Cd').isin(drop_dmas))
+    return panelist_filter
+
+
+def _add_trip_dates(df_trips):
+    """Parse purchase_date and add the scanner calendar columns to trips."""
+    dates = _parse_dates(df_trips['purchase_date'])
+    df_trips = df_trips.set_column(
+        df_trips.column_names.index('purchase_date'), 'purchase_date', dates)
+    for name, col in _calendar_columns(dates).items():
+        df_trips = df_trips.append_column(name, col)
+    return df_trips
+
+
+def _purchase_trip_columns(add_household = False, add_trip_info = False,
+                           add_dates = False):
+    """Trip columns read_year attaches to purchases."""
+    trip_cols = []
+    if add_household:
+        trip_cols.append('household_code')
+    if add_trip_info:
+        trip_cols += ['purchase_date', 'retailer_code', 'store_code_uc']
+        if add_dates:
+            trip_cols.append('week_end')
+    return trip_cols
+
+
+def _search_sorted(sorted_keys, query):
+    """Binary search each query value in a sorted NumPy key array.
+    Returns (positions, found) where found marks exact matches.
+    """
+    if len(sorted_keys) == 0:
+        return np.zeros(len(query), dtype=np.int64), np.zeros(len(query), dtype=bool)
+    pos = np.minimum(np.searchsorted(sorted_keys, query), len(sorted_keys) - 1)
+    return pos, sorted_keys[pos] == query
+
+
+class _KeySet:
+    """Set of integer keys for repeated semi-join filtering.
+
+    Holds the unique keys both as an Arrow array (usable as a dataset
+    isin value set) and as a sorted NumPy array, so membership tests on
+    each streamed batch are a binary search rather than rebuilding a
+    hash table from a Python list every call.
+    """
+
+    def __init__(self, values):
+        if isinstance(values, pa.ChunkedArray):
+            values = values.combine_chunks()
+        values = pc.unique(values).drop_null()
+        self.values = values.take(pc.sort_indices(values))
+        self._sorted = self.values.to_numpy()
+
+    def __len__(self):
+        return len(self._sorted)
+
+    def contains(self, arr):
+        """Return a boolean Arrow array: is each element of arr in the set."""
+        _, mask = _search_sorted(self._sorted, pc.fill_null(arr, 0).to_numpy())
+        if arr.null_count:
+            mask &= pc.is_valid(arr).to_numpy(zero_copy_only=False)
+        return pa.array(mask)
+
+
+class _SortedIndex:
+    """Rows of a table sorted on one integer key.
+
+    Another table is enriched with columns from this one by a vectorized
+    binary search for each key followed by take, which keeps the row
+    order of the table being enriched and avoids a hash join. Used for
+    trips (trip_code_uc), panelists (household_code) and products.
+    """
+
+    def __init__(self, table, key, columns=None, key_values=None):
+        """
+        table: the lookup table
+        key: name of the key column
+        columns: columns to keep (default: all)
+        key_values: optional NumPy keys to use instead of table[key],
+            e.g. composite keys built from several columns
+        """
+        if columns is not None:
+            columns = [c for c in columns if c in table.column_names and c != key]
+            table = table.select([key] + columns)
+        if key_values is None:
+            key_values = table[key].to_numpy()
+        order = np.argsort(key_values, kind='stable')
+        self.table = table.take(pa.array(order))
+        self._keys = key_values[order]
+
+    def positions(self, query):
+        """Return the row of each query key in self.table, null if absent."""
+        if isinstance(query, (pa.Array, pa.ChunkedArray)):
+            query = query.to_numpy()
+        pos, found = _search_sorted(self._keys, query)
+        return pa.array(pos, pa.int64(), mask=~found)
+
+    def enrich(self, df, columns, query=None):
+        """Append the given columns to df, matched on the key column of df
+        (or on the query keys, if given)."""
+        idx = self.positions(df[self.table.column_names[0]] if query is None else query)
+        for col in columns:
+            df = df.append_column(col, self.table[col].take(idx))
+        return df
+
+
+class RmsResolver:
+    """Sorted-array lookup from (upc, panel_year) to upc_ver_uc.
+
+    Built once from the rms_versions files: the composite key
+    (upc << 16) | panel_year is stored as a sorted uint64 array next to the
+    matching version array, so resolving the versions of scanner sales is
+    a vectorized binary search instead of a hash join per Movement file.
+    """
+
+    def __init__(self, keys, versions, source = None):
+        self.keys = keys
+        self.versions = versions
+        # description of the files the resolver was built from (see save)
+        self.source = source
+
+    @staticmethod
+    def make_keys(upc, panel_year):
+        """Combine upc and panel_year arrays into uint64 composite keys."""
+        return _composite_key(upc, panel_year)
+
+    @classmethod
+    def from_table(cls, df_rms):
+        """Build the resolver from a table with upc, upc_ver_uc, panel_year."""
+        return cls.from_tables([df_rms])
+
+    @classmethod
+    def from_tables(cls, tables, source = None):
+        """Build the resolver from an iterable of upc, upc_ver_uc, panel_year
+        tables (e.g. one per year), converting each to key and version
+        arrays as it arrives so the tables are never held together."""
+        keys, versions = [np.empty(0, np.uint64)], [np.empty(0, np.uint8)]
+        for df in tables:
+            keys.append(cls.make_keys(df['upc'].to_numpy(), df['panel_year'].to_numpy()))
+            versions.append(df['upc_ver_uc'].to_numpy().astype(np.uint8))
+        keys = np.concatenate(keys)
+        versions = np.concatenate(versions)
+        # stable sort so the first listed version wins on duplicate keys
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        versions = versions[order]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        return cls(keys[first], versions[first], source)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a resolver written by save()."""
+        with np.load(filename) as f:
+            source = json.loads(str(f['source'])) if 'source' in f.files else None
+            return cls(f['keys'], f['versions'], source)
+
+    def save(self, filename):
+        """Serialize the key and version arrays, and the source description,
+        to an .npz file at exactly filename (no suffix is added)."""
+        with open(filename, 'wb') as f:
+            np.savez(f, keys=self.keys, versions=self.versions,
+                     source=np.array(json.dumps(self.source)))
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.versions.nbytes
+
+    def lookup(self, upc, panel_year):
+        """Return upc_ver_uc as a uint8 Arrow array, null where unmatched."""
+        if isinstance(upc, (pa.Array, pa.ChunkedArray)):
+            upc = upc.to_numpy()
+        if isinstance(panel_year, (pa.Array, pa.ChunkedArray)):
+            panel_year = panel_year.to_numpy()
+        pos, found = _search_sorted(self.keys, self.make_keys(upc, panel_year))
+        if len(self.keys) == 0:
+            return pa.nulls(len(pos), pa.uint8())
+        return pa.array(self.versions[pos], type=pa.uint8(), mask=~found)
+
+    def to_table(self):
+        """Expand back to a upc, upc_ver_uc, panel_year table."""
+        return pa.table({
+            'upc': pa.array(self.keys >> np.uint64(16), pa.uint64()),
+            'upc_ver_uc': pa.array(self.versions, pa.uint8()),
+            'panel_year': pa.array((self.keys & np.uint64(0xFFFF)).astype(np.uint16),
+                                   pa.uint16())})
+
+
+class PurchaseMatrix:
+    """Sparse household-period x product spend and quantity matrices.
+
+    Entries are stored in COO form sorted by row then column:
+        row, col: int32 row and column codes
+        spend, quantity: float64 values for each entry
+        row_labels: pyarrow Table (household_code, period) for each row code
+        col_labels: pyarrow Array of product codes for each column code
+    to_csr() converts to CSR index arrays without needing scipy.
+    """
+
+    def __init__(self, row, col, spend, quantity, row_labels, col_labels):
+        self.row = row
+        self.col = col
+        self.spend = spend
+        self.quantity = quantity
+        self.row_labels = row_labels
+        self.col_labels = col_labels
+        self.shape = (row_labels.num_rows, len(col_labels))
+
+    @property
+    def nnz(self):
+        return len(self.row)
+
+    def to_csr(self, values = 'spend'):
+        """Return (indptr, indices, data) for the spend or quantity matrix."""
+        indptr = np.zeros(self.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.row, minlength=self.shape[0]), out=indptr[1:])
+        return indptr, self.col, getattr(self, values)
+
+    def to_scipy(self, values = 'spend'):
+        """Return a scipy.sparse.csr_matrix (requires scipy)."""
+        from scipy import sparse
+        indptr, indices, data = self.to_csr(values)
+        return sparse.csr_matrix((data, indices, indptr), shape=self.shape)
+
+
+def _keyed_upsert(target, patch, keys, insert=False, suffix=None):
+    """Patch the rows of target whose keys appear in patch.
+
+    For every non-key column the two tables share, matched rows take the
+    patch value where it is not null (like pandas DataFrame.update, but
+    aligned on keys instead of position). Columns without changes are
+    kept as is. If a key appears more than once in patch, its last row
+    wins. A column whose type cannot hold the patch values is widened
+    (with a warning) rather than truncated.
+    With insert=True, patch rows with no match are appended.
+    With a suffix, patch values are instead added as new columns named
+    column + suffix (null for unmatched rows), keeping the originals.
+    Empty or non-Arrow targets are returned unchanged.
+    """
+    if not isinstance(target, pa.Table) or target.num_rows == 0:
+        return target
+    missing = [k for k in keys if k not in target.column_names or k not in patch.column_names]
+    if missing:
+        warnings.warn(f"Cannot apply revisions: key columns {missing} not found",
+                      UserWarning, stacklevel=3)
+        return target
+
+    # match on the key columns only, with row numbers on both sides
+    left = target.select(keys).append_column(
+        '__target_row', pa.array(np.arange(target.num_rows)))
+    right = patch.select(keys).append_column(
+        '__patch_row', pa.array(np.arange(patch.num_rows)))
+    for k in keys:
+        right = right.set_column(right.column_names.index(k), k,
+                                 pc.cast(right[k], left[k].type))
+    # one row per key: the last one in the patch file
+    last = right.group_by(keys).aggregate([('__patch_row', 'max')])
+    right = last.select(keys).append_column('__patch_row', last['__patch_row_max'])
+    matched = left.join(right, keys = keys, join_type = 'inner')
+    patch_pos = np.full(target.num_rows, -1, dtype=np.int64)
+    patch_pos[matched['__target_row'].to_numpy()] = matched['__patch_row'].to_numpy()
+    idx = pa.array(patch_pos, mask = patch_pos < 0)
+
+    for col in patch.column_names:
+        if col in keys or col not in target.column_names:
+            continue
+        new_vals = patch[col].take(idx)
+        if suffix is not None:
+            name = col + suffix
+            if name in target.column_names:
+                target = target.set_column(target.column_names.index(name), name, new_vals)
+            else:
+                target = target.append_column(name, new_vals)
+            continue
+        if new_vals.null_count == len(new_vals):
+            continue
+        old_vals = target[col]
+        value_type = old_vals.type
+        if pa.types.is_dictionary(value_type):
+            old_vals = old_vals.cast(value_type.value_type)
+        try:
+            new_vals = new_vals.cast(old_vals.type)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            wide = _unify_schemas([pa.schema([(col, old_vals.type)]),
+                                   pa.schema([(col, new_vals.type)])]).field(col).type
+            warnings.warn(f"Revised values of {col} do not fit {old_vals.type}; "
+                          f"widening the column to {wide}", UserWarning, stacklevel=3)
+            old_vals = old_vals.cast(wide)
+            new_vals = new_vals.cast(wide)
+        new_vals = pc.if_else(pc.is_valid(new_vals), new_vals, old_vals)
+        if pa.types.is_dictionary(value_type):
+            new_vals = pc.dictionary_encode(new_vals)
+        target = target.set_column(target.column_names.index(col), col, new_vals)
+
+    if insert:
+        new_rows = np.setdiff1d(right['__patch_row'].to_numpy(),
+                                matched['__patch_row'].to_numpy())
+        if len(new_rows):
+            df_new = patch.take(pa.array(new_rows))
+            # keep the target's types where the new values fit them
+            for field in target.schema:
+                if field.name not in df_new.column_names:
+                    continue
+                value_type = field.type.value_type if pa.types.is_dictionary(field.type) else field.type
+                try:
+                    vals = df_new[field.name].cast(value_type)
+                except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                    continue
+                if pa.types.is_dictionary(field.type):
+                    vals = pc.dictionary_encode(vals)
+                df_new = df_new.set_column(df_new.column_names.index(field.name), field.name, vals)
+            target = pa.concat_tables([target, df_new], promote_options = 'permissive')
+    return target
+
+
+def _write_ipc(df, filename, compression = None):
+    """Write a table, or a sink dataset year by year, to an Arrow IPC file
+    (uncompressed by default).
+    IPC files allow one dictionary per field, so the dictionaries of
+    chunked dictionary columns (e.g. one chunk per year) are unified first.
+    """
+    options = pa.ipc.IpcWriteOptions(compression = compression)
+    if isinstance(df, pads.Dataset):
+        # streamed one year at a time: dictionaries cannot be unified
+        # across years up front, so dictionary columns are written as values
+        schema = pa.schema([pa.field(f.name, f.type.value_type)
+                            if pa.types.is_dictionary(f.type) else f for f in df.schema])
+        with pa.OSFile(str(filename), 'wb') as sink:
+            with pa.ipc.new_file(sink, schema, options = options) as writer:
+                for part in _dataset_parts(df):
+                    writer.write_table(part.cast(schema))
+        return filename
+    df = df.unify_dictionaries()
+    with pa.OSFile(str(filename), 'wb') as sink:
+        with pa.ipc.new_file(sink, df.schema, options = options) as writer:
+            writer.write_table(df)
+    return filename
+
+
+def _read_ipc(filename):
+    """Read an Arrow IPC file written by _write_ipc back into memory."""
+    with pa.OSFile(str(filename), 'rb') as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def _unify_schemas(schemas):
+    """
+    Combine the schemas of several years into one explicit schema: fields
+    in first-seen order, a type shared by all years kept as is, otherwise
+    promoted where pyarrow can (null -> any, narrower -> wider numerics,
+    dictionary -> values), and string where the
+    years disagree otherwise (e.g. a code read as int one year and as text
+    the next).
+    """
+    types = {}
+    for schema in schemas:
+        for field in schema:
+            types.setdefault(field.name, []).append(field.type)
+    fields = []
+    for name, field_types in types.items():
+        if all(t == field_types[0] for t in field_types):
+            fields.append(pa.field(name, field_types[0]))
+            continue
+        field_types = [t.value_type if pa.types.is_dictionary(t) else t
+                       for t in field_types]
+        try:
+            unified = pa.unify_schemas([pa.schema([(name, t)]) for t in field_types],
+                                       promote_options = 'permissive').field(name).type
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            unified = pa.string()
+        fields.append(pa.field(name, unified))
+    return pa.schema(fields)
+
+
+def _sink_dataset(dir_table, schema):
+    """Open a per-year sink written by _sink_year as a lazy dataset."""
+    partitioning = pads.partitioning(pa.schema([schema.field('panel_year')]),
+                                     flavor = 'hive')
+    return pads.dataset(dir_table, schema = schema, format = 'parquet',
+                        partitioning = partitioning)
+
+
+def _dataset_years(dataset):
+    """Sorted panel_year values of a sink dataset."""
+    return sorted(pc.unique(dataset.to_table(columns = ['panel_year'])['panel_year']).to_pylist())
+
+
+def _dataset_parts(dataset, columns = None):
+    """Yield a sink dataset one panel_year partition at a time, so writing
+    it out holds a single year in memory."""
+    for year in _dataset_years(dataset):
+        yield dataset.to_table(columns = columns, filter = pc.field('panel_year') == year)
+
+
+def _sink_year(tables, year, sink, stub = 'out', compr = 'brotli', stats = None):
+    """
+    Write one year's tables ({name: table}) to
+    sink/[stub]_[name]/panel_year=[year]/part-0.parquet. panel_year is kept
+    in the directory name only. Returns {name: (file schema, panel_year type)}.
+    Each file is recorded as a write span in stats, if given.
+    """
+    if stats is None:
+        stats = ReaderStats()
+    schemas = {}
+    for name, df in tables.items():
+        dir_year = path.Path(sink) / '{stub}_{n}'.format(stub=stub, n=name) / 'panel_year={y}'.format(y=year)
+        dir_year.mkdir(parents = True, exist_ok = True)
+        year_type = pa.int64()
+        if 'panel_year' in df.column_names:
+            year_type = df.schema.field('panel_year').type
+            df = df.drop_columns(['panel_year'])
+        with stats.span('write', dir_year / 'part-0.parquet', rows_in = df.num_rows):
+            pq.write_table(df, dir_year / 'part-0.parquet', **_parquet_options(df.schema, compr))
+        schemas[name] = (df.schema, year_type)
+    return schemas
+
+
+# reader copy of each process pool worker, sent once by _init_worker
+_worker_reader = None
+
+
+def _init_worker(reader):
+    """ProcessPoolExecutor initializer: keep the reader (see
+    PanelReader._worker_copy) for all the years this worker reads."""
+    global _worker_reader
+    _worker_reader = reader
+
+
+def _sink_year_worker(year, sink, stub, compr, kwargs):
+    """Run PanelReader._read_year_tables in a worker process and write the
+    results straight to the sink, returning only their schemas and the
+    year's stats spans."""
+    reader = _worker_reader
+    reader.stats = ReaderStats()
+    df_panelists, df_trips, df_purchases = reader._read_year_tables(year, **kwargs)
+    schemas = _sink_year({'panelists': df_panelists, 'trips': df_trips,
+                          'purchases': df_purchases}, year, sink, stub, compr,
+                         reader.stats)
+    return schemas, reader.stats.spans
+
+
+def _read_year_worker(year, dir_tmp, kwargs):
+    """Run PanelReader.read_year in a worker process.
+    Tables are handed back as Arrow IPC files in dir_tmp rather than pickled,
+    along with the year's stats spans.
+    """
+    reader = _worker_reader
+    reader.stats = ReaderStats()
+    reader.df_panelists, reader.df_trips, reader.df_purchases = [], [], []
+    reader.read_year(year, **kwargs)
+    files = {name: _write_ipc(getattr(reader, name)[-1],
+                              path.Path(dir_tmp) / '{n}_{y}.arrow'.format(n=name, y=year))
+             for name in ('df_panelists', 'df_trips', 'df_purchases')}
+    return files, reader.stats.spans
+
+
+# Named compression profiles accepted wherever a compr argument is taken;
+# any other value is passed to parquet as a plain codec name
+COMPRESSION_PROFILES = {
+    'fast': {'compression': 'lz4'},
+    'balanced': {'compression': 'zstd', 'compression_level': 3},
+    'archive': {'compression': 'zstd', 'compression_level': 19},
+}
+
+# Continuous float columns, matched case-insensitively, that profiles write
+# with byte-stream-split instead of dictionary encoding; the scanner shelf
+# price column price repeats heavily and stays dictionary encoded.
+BYTE_STREAM_SPLIT_COLUMNS = {'unit_price', 'revenue', 'total_price_paid',
+                             'coupon_value', 'total_spent',
+                             'projection_factor', 'projection_factor_magnet'}
+
+
+def _parquet_options(schema, compr = 'brotli'):
+    """
+    Translate compr (a codec name or a COMPRESSION_PROFILES key) into
+    keyword arguments for pq.write_table / pq.ParquetWriter.
+    Profiles also set per-column encodings for the given schema.
+    """
+    if compr not in COMPRESSION_PROFILES:
+        return {'compression': compr}
+    options = dict(COMPRESSION_PROFILES[compr])
+    split = [f.name for f in schema
+             if f.name.lower() in BYTE_STREAM_SPLIT_COLUMNS and pa.types.is_floating(f.type)]
+    options['use_dictionary'] = [f.name for f in schema if f.name not in split]
+    if split:
+        options['use_byte_stream_split'] = split
+    return options
+
+
 def aux_write_direct(df, filename, compr = 'brotli'):
     if isinstance(df, pa.Table):
         if df.num_rows == 0:
             return
-        pq.write_table(df, filename, compression = compr)
+        pq.write_table(df, filename, **_parquet_options(df.schema, compr))
         print('Wrote as direct parquet to', filename)
     elif isinstance(df, pd.DataFrame):
         if df.empty:
             return
-        pq.write_table(pa.Table.from_pandas(df, preserve_index=False),
-                        filename, compression = compr)
+        df = pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_table(df, filename, **_parquet_options(df.schema, compr))
+        print('Wrote as direct parquet to', filename)
+    elif isinstance(df, pads.Dataset):
+        # a read_annual(sink=...) table: stream it one year at a time
+        if df.count_rows() == 0:
+            return
+        with pq.ParquetWriter(filename, df.schema, **_parquet_options(df.schema, compr)) as writer:
+            for part in _dataset_parts(df):
+                writer.write_table(part)
         print('Wrote as direct parquet to', filename)
     return
 
+
+def _ipc_compression(compr):
+    """
+    IPC buffer compression for compr: 'lz4' or 'zstd' (also via a
+    COMPRESSION_PROFILES key), otherwise None, i.e. uncompressed files that
+    can be memory-mapped without copying.
+    """
+    codec = COMPRESSION_PROFILES.get(compr, {}).get('compression', compr)
+    return codec if codec in ('lz4', 'zstd') else None
+
+
+def aux_write_ipc(df, filename, compr = None):
+    if isinstance(df, pd.DataFrame):
+        if df.empty:
+            return
+        df = pa.Table.from_pandas(df, preserve_index=False)
+    if isinstance(df, pads.Dataset):
+        if df.count_rows() == 0:
+            return
+    elif not isinstance(df, pa.Table) or df.num_rows == 0:
+        return
+    _write_ipc(df, filename, _ipc_compression(compr))
+    print('Wrote as Arrow IPC to', filename)
+    return
+
+
+def aux_load_ipc(reader, names, dir_load, stub = 'out'):
+    """
+    Memory-map the [stub]_[name].arrow files written by
+    write_data(format='ipc') into reader.df_[name]. Uncompressed files are
+    not copied: the tables point into the mapped files.
+    """
+    dir_load = path.Path(dir_load)
+    loaded = []
+    for name in names:
+        filename = dir_load / '{stub}_{n}.arrow'.format(stub=stub, n=name)
+        if not filename.exists():
+            continue
+        source = pa.memory_map(str(filename), 'r')
+        setattr(reader, 'df_' + name, pa.ipc.open_file(source).read_all())
+        loaded.append(name)
+    if not loaded:
+        raise FileNotFoundError('No {stub}_*.arrow files found in {d}'.format(stub=stub, d=dir_load))
+    if reader.verbose:
+        print('Loaded', ', '.join(loaded), 'from', dir_load)
+    return reader
+
+
+def benchmark_codecs(table, compr = ('fast', 'balanced', 'archive', 'snappy', 'brotli'),
+                     sample_rows = 1000000, repeats = 1):
+    """
+    Function: compares parquet codecs / compression profiles on a sample of
+    a table, writing to and reading back from memory
+    Arguments:
+        table: PyArrow Table or pandas DataFrame (e.g. RR.df_sales)
+        compr: codec names or COMPRESSION_PROFILES keys to try
+        sample_rows: number of rows to use (None for all), taken as 100
+            evenly spaced row ranges across the table so that e.g. every
+            module-year of df_sales is represented
+        repeats: number of timed runs per codec (the fastest is kept)
+    Returns a PyArrow Table with one row per codec:
+        compr, rows, bytes, ratio, write_seconds, read_seconds
+    where ratio is the in-memory Arrow size over the parquet size.
+    """
+    if isinstance(table, pd.DataFrame):
+        table = pa.Table.from_pandas(table, preserve_index=False)
+    if sample_rows is not None and table.num_rows > sample_rows:
+        # contiguous ranges keep the runs that compression depends on
+        n_ranges = min(100, sample_rows)
+        length = sample_rows // n_ranges
+        starts = np.linspace(0, table.num_rows - length, n_ranges).astype(np.int64)
+        table = pa.concat_tables([table.slice(start, length) for start in starts]).combine_chunks()
+    results = []
+    for codec in compr:
+        options = _parquet_options(table.schema, codec)
+        write_seconds = read_seconds = float('inf')
+        for _ in range(repeats):
+            sink = pa.BufferOutputStream()
+            start = time.perf_counter()
+            pq.write_table(table, sink, **options)
+            write_seconds = min(write_seconds, time.perf_counter() - start)
+            buf = sink.getvalue()
+
+            start = time.perf_counter()
+            pq.read_table(pa.BufferReader(buf))
+            read_seconds = min(read_seconds, time.perf_counter() - start)
+        results.append({'compr': codec, 'rows': table.num_rows,
+                        'bytes': buf.size, 'ratio': table.nbytes / max(buf.size, 1),
+                        'write_seconds': write_seconds, 'read_seconds': read_seconds})
+    return pa.Table.from_pylist(results)
+
+def _run_writes(jobs, max_workers = None, stats = None):
+    """
+    Run a list of (function, args) write jobs, concurrently in a thread
+    pool if max_workers > 1. Arrow releases the GIL while encoding and
+    compressing, so independent tables are written in parallel.
+    Each job is recorded as a write span in stats, if given, labelled with
+    its output path (or the function name).
+    """
+    if stats is not None:
+        def timed(func):
+            def aux_timed(*args):
+                label = next((a for a in args if isinstance(a, path.PurePath)), func.__name__)
+                with stats.span('write', label):
+                    return func(*args)
+            return aux_timed
+        jobs = [(timed(func), args) for func, args in jobs]
+
+    if max_workers is None or max_workers <= 1:
+        for func, args in jobs:
+            func(*args)
+        return
+    with ThreadPoolExecutor(max_workers = max_workers) as pool:
+        futures = [pool.submit(func, *args) for func, args in jobs]
+        for future in futures:
+            future.result()
+    return
+
+
+def _write_household_sorted(df, filename, index_filename, compr = 'brotli',
+                            row_group_size = 1000000):
+    """
+    Write purchases sorted by household_code and panel_year so row group
+    statistics on household_code are tight, plus a sidecar index with one
+    row per household, year and row group:
+        household_code, panel_year, file, row_group, row_start, row_end
+    where rows [row_start, row_end) of that row group belong to the household.
+    df can also be an iterable of tables with one schema (e.g. one per
+    panel_year); each is then sorted and written in its own row groups,
+    so the file is ordered by part first.
+    """
+    parts = [df] if isinstance(df, pa.Table) else df
+    writer = None
+    index = []
+    first_group = 0
+    try:
+        for df in parts:
+            if df.num_rows == 0:
+                continue
+            sort_keys = [('household_code', 'ascending')]
+            if 'panel_year' in df.column_names:
+                sort_keys.append(('panel_year', 'ascending'))
+            df = df.sort_by(sort_keys)
+            if writer is None:
+                writer = pq.ParquetWriter(filename, df.schema,
+                                          **_parquet_options(df.schema, compr))
+            writer.write_table(df, row_group_size = row_group_size)
+
+            # runs of (household, year) cut at row group boundaries
+            households = df['household_code'].to_numpy()
+            if 'panel_year' in df.column_names:
+                years = pc.cast(df['panel_year'], pa.uint16()).to_numpy()
+            else:
+                years = np.zeros(df.num_rows, dtype=np.uint16)
+            rows = np.arange(df.num_rows)
+            starts = np.flatnonzero((np.diff(households, prepend = households[0] + 1) != 0) |
+                                    (np.diff(years, prepend = years[0] + 1) != 0) |
+                                    (rows % row_group_size == 0))
+            ends = np.append(starts[1:], df.num_rows)
+            row_group = starts // row_group_size
+
+            index.append(pa.table({
+                'household_code': pa.array(households[starts], pa.uint32()),
+                'panel_year': pa.array(years[starts], pa.uint16()),
+                'file': pa.array([path.Path(filename).name] * len(starts), pa.string()),
+                'row_group': pa.array(first_group + row_group, pa.int32()),
+                'row_start': pa.array(starts - row_group * row_group_size, pa.int64()),
+                'row_end': pa.array(ends - row_group * row_group_size, pa.int64())}))
+            first_group += -(-df.num_rows // row_group_size)
+    finally:
+        if writer is not None:
+            writer.close()
+    if not index:
+        return
+    index = pa.concat_tables(index)
+    pq.write_table(index, index_filename, **_parquet_options(index.schema, compr))
+    return
+
+
+SEPARATED_KEY = b'kiltsreader.separated'
+
+
+def _write_separated(df, filename, separator, compr = 'brotli',
+                     row_group_size = 1000000):
+    """
+    Write df sorted once by the separator column, one run of row groups per
+    separator value (each capped at row_group_size rows). The file's
+    key-value metadata records the separator and, for each value, its first
+    row group and number of row groups:
+        {"separator": ..., "row_groups": [[value, first, count], ...]}
+    df can also be a sink dataset with separator panel_year; it is then
+    written one year partition at a time.
+    """
+    if isinstance(df, pads.Dataset):
+        years = _dataset_years(df)
+        counts = [(y, df.count_rows(filter = pc.field('panel_year') == y)) for y in years]
+        runs = _dataset_parts(df)
+        schema = df.schema
+    else:
+        df = df.take(pc.sort_indices(df[separator]))
+        counts = [(c['values'], c['counts']) for c in pc.value_counts(df[separator]).to_pylist()]
+        offsets = np.cumsum([0] + [n for _, n in counts])
+        runs = (df.slice(offset, n) for offset, (_, n) in zip(offsets, counts))
+        schema = df.schema
+
+    entries = []
+    first = 0
+    for value, count in counts:
+        n_groups = -(-count // row_group_size)
+        entries.append([value, first, n_groups])
+        first += n_groups
+    meta = dict(schema.metadata or {})
+    meta[SEPARATED_KEY] = json.dumps({'separator': separator,
+                                      'row_groups': entries},
+                                     default = str).encode()
+    schema = schema.with_metadata(meta)
+
+    with pq.ParquetWriter(filename, schema, **_parquet_options(schema, compr)) as writer:
+        for run in runs:
+            # each write_table call starts a fresh row group
+            writer.write_table(run.replace_schema_metadata(meta),
+                               row_group_size = row_group_size)
+    return
+
+
+# key columns that get parquet bloom filters in clustered sales output
+BLOOM_FILTER_COLUMNS = ('upc', 'store_code_uc')
+
+# bloom_filter_options is only available in recent pyarrow releases
+_HAS_BLOOM_FILTERS = 'bloom_filter_options' in inspect.signature(pq.ParquetWriter.__init__).parameters
+
+
+def _sales_columns(df, columns, df_products = None):
+    """
+    Return {column: array} for the given columns of a sales table.
+    Columns missing from df but present in df_products (e.g.
+    product_module_code) are looked up on (upc, upc_ver_uc).
+    """
+    arrays = {}
+    index = None
+    for col in columns:
+        if col in df.column_names:
+            arrays[col] = df[col]
+            continue
+        if not isinstance(df_products, pa.Table) or col not in df_products.column_names:
+            raise ValueError('{c} is not a sales or product column'
+                             ' (run read_products() first for product columns)'.format(c=col))
+        if index is None:
+            index = _SortedIndex(df_products, 'upc',
+                                 key_values = _composite_key(df_products['upc'].to_numpy(),
+                                                             df_products['upc_ver_uc'].to_numpy()))
+            pos = index.positions(_composite_key(df['upc'].to_numpy(),
+                                                 df['upc_ver_uc'].to_numpy()))
+        arrays[col] = index.table[col].take(pos)
+    return arrays
+
+
+def _cluster_order(df, cluster_by, df_products = None):
+    """
+    Return the row order (an Arrow index array) that sorts df by the
+    cluster_by columns. Product columns are looked up for the sort only
+    and are not added to df.
+    """
+    return pc.sort_indices(pa.table(_sales_columns(df, cluster_by, df_products)),
+                           sort_keys = [(col, 'ascending') for col in cluster_by])
+
+
+def _write_hive_dataset(df, base_dir, partition_cols, compr = 'brotli',
+                        max_rows_per_file = None, row_group_size = 1000000,
+                        order = None):
+    """
+    Write df as a hive-partitioned parquet dataset (col=value/ directories)
+    with bounded file and row group sizes, replacing any files previously
+    written to the same partitions. Also writes _common_metadata (the file
+    schema) and _metadata (the schema plus every file's row group metadata),
+    so readers can plan a scan without opening each file.
+    If order is given, rows are written in that order.
+    """
+    base_dir = path.Path(base_dir)
+    if max_rows_per_file:
+        row_group_size = min(row_group_size, max_rows_per_file)
+
+    if order is None:
+        data = df
+    else:
+        # take sorted rows one row group at a time
+        data = (batch for start in range(0, len(order), row_group_size)
+                for batch in df.take(order.slice(start, row_group_size)).to_batches())
+
+    collected = []
+    def visitor(written_file):
+        written_file.metadata.set_file_path(
+            path.Path(written_file.path).relative_to(base_dir).as_posix())
+        collected.append(written_file.metadata)
+
+    fmt = pads.ParquetFileFormat()
+    pads.write_dataset(data, base_dir, format = fmt, schema = df.schema,
+                       partitioning = partition_cols, partitioning_flavor = 'hive',
+                       file_options = fmt.make_write_options(**_parquet_options(df.schema, compr)),
+                       basename_template = 'part-{i}.parquet',
+                       existing_data_behavior = 'delete_matching',
+                       preserve_order = order is not None,
+                       max_partitions = 1 << 16,
+                       max_rows_per_file = max_rows_per_file,
+                       max_rows_per_group = row_group_size,
+                       min_rows_per_group = min(row_group_size, 1 << 16),
+                       file_visitor = visitor)
+
+    if not collected:
+        return
+    # part files from earlier writes to other partitions are kept: include them
+    written = {md.row_group(0).column(0).file_path for md in collected if md.num_row_groups}
+    for f in sorted(base_dir.rglob('*.parquet')):
+        rel = f.relative_to(base_dir).as_posix()
+        if rel not in written:
+            md = pq.read_metadata(f)
+            md.set_file_path(rel)
+            collected.append(md)
+
+    schema = collected[0].schema.to_arrow_schema()
+    pq.write_metadata(schema, base_dir / '_common_metadata')
+    summary = None
+    for md in collected:
+        if md.num_row_groups == 0:
+            continue
+        if summary is None:
+            summary = md
+        else:
+            summary.append_row_groups(md)
+    if summary is not None:
+        summary.write_metadata_file(base_dir / '_metadata')
+    return
+
+
+def _write_clustered(df, filename, order, cluster_by, compr = 'brotli',
+                     row_group_size = 1000000):
+    """
+    Write df in the given row order, taking one row group at a time so
+    only a single sorted row group is materialized next to df. Row groups
+    are capped at row_group_size rows and the file gets page indexes,
+    sorting-column metadata and (where pyarrow supports them) bloom
+    filters on the BLOOM_FILTER_COLUMNS.
+    """
+    options = _parquet_options(df.schema, compr)
+    options['write_page_index'] = True
+
+    # sorting metadata only holds for the leading columns stored in df
+    sorting = []
+    for col in cluster_by:
+        if col not in df.column_names:
+            break
+        sorting.append(pq.SortingColumn(df.schema.get_field_index(col)))
+    if sorting:
+        options['sorting_columns'] = sorting
+
+    bloom = [c for c in BLOOM_FILTER_COLUMNS if c in df.column_names]
+    if bloom and _HAS_BLOOM_FILTERS:
+        # size each filter for the distinct values a row group can hold
+        options['bloom_filter_options'] = {
+            c: {'ndv': max(min(row_group_size, pc.count_distinct(df[c]).as_py()), 1),
+                'fpp': 0.05} for c in bloom}
+
+    with pq.ParquetWriter(filename, df.schema, **options) as writer:
+        for start in range(0, len(order), row_group_size):
+            writer.write_table(df.take(order.slice(start, row_group_size)),
+                               row_group_size = row_group_size)
+    return
+
+
+def load_separated(filename, values, columns = None):
+    """
+    Function: reads the rows for selected separator values (e.g. panel
+    years) from a file written by PanelReader.write_data(as_table=True)
+    Arguments:
+        filename: path to the parquet file
+        values: list of separator values to keep
+        columns: optional list of columns to read
+    Only the row groups recorded for those values in the file metadata
+    are read; no statistics are scanned.
+    """
+    pf = pq.ParquetFile(filename)
+    meta = (pf.schema_arrow.metadata or {}).get(SEPARATED_KEY)
+    if meta is None:
+        raise ValueError('{f} was not written with a separator'.format(f=filename))
+    entries = json.loads(meta)['row_groups']
+    keep = {str(v) for v in values}
+    groups = [g for value, first, n in entries if str(value) in keep
+              for g in range(first, first + n)]
+    if not groups:
+        schema = pf.schema_arrow
+        if columns is not None:
+            schema = pa.schema([schema.field(c) for c in columns])
+        return schema.empty_table()
+    return pf.read_row_groups(groups, columns = columns)
+
+
+def _output_dataset(dir_read, name, stub = 'out'):
+    """
+    Open a write_data output as a pyarrow dataset. dir_read may be the
+    output file or dataset directory itself, or the write_data directory,
+    in which case [stub]_[name]/ (hive dataset), [stub]_[name].parquet and
+    [stub]_[name].arrow are tried in that order. Hive datasets with a
+    _metadata file are opened from it without reading every footer.
+    """
+    dir_read = path.Path(dir_read)
+    candidates = [dir_read / '{stub}_{n}'.format(stub=stub, n=name),
+                  dir_read / '{stub}_{n}.parquet'.format(stub=stub, n=name),
+                  dir_read / '{stub}_{n}.arrow'.format(stub=stub, n=name)]
+    found = [c for c in candidates if c.exists()]
+    if found and not dir_read.is_file():
+        source = found[0]
+    elif dir_read.is_file() or (dir_read.is_dir() and any(
+            '=' in c.name or c.name in ('_metadata', '_common_metadata')
+            for c in dir_read.iterdir())):
+        # the output file or hive dataset directory itself
+        source = dir_read
+    else:
+        raise FileNotFoundError('Could not find {stub}_{n} output in {d}'.format(
+            stub=stub, n=name, d=dir_read))
+    if source.suffix == '.arrow':
+        return pads.dataset(source, format = 'ipc')
+    if source.is_dir() and (source / '_metadata').exists():
+        return pads.parquet_dataset(source / '_metadata', partitioning = 'hive')
+    if source.is_dir() and (source / '_common_metadata').exists():
+        # per-year sink from read_annual(sink=...): use its unified schema
+        return _sink_dataset(source, pq.read_schema(source / '_common_metadata'))
+    return pads.dataset(source, format = 'parquet', partitioning = 'hive')
+
+
+def _scan_output(dataset, columns = None, filters = None, map_func = None,
+                 max_workers = None):
+    """
+    Read a dataset with column projection and an optional filter (a pyarrow
+    expression or pq-style DNF list). Partitions and parquet row groups whose
+    statistics cannot match are skipped. With map_func, each remaining
+    fragment (one per parquet row group) is read and passed to map_func in a
+    thread pool; table results are concatenated, anything else is returned
+    as a list.
+    """
+    if isinstance(filters, list):
+        filters = pq.filters_to_expression(filters)
+    if map_func is None:
+        return dataset.to_table(columns = columns, filter = filters)
+
+    fragments = []
+    for fragment in dataset.get_fragments(filter = filters):
+        if isinstance(fragment, pads.ParquetFileFragment):
+            fragments.extend(fragment.split_by_row_group(filters, schema = dataset.schema))
+        else:
+            fragments.append(fragment)
+
+    def aux_map(fragment):
+        return map_func(fragment.to_table(schema = dataset.schema, columns = columns,
+                                          filter = filters))
+
+    if not fragments:
+        results = [map_func(dataset.schema.empty_table().select(columns or dataset.schema.names))]
+    else:
+        with ThreadPoolExecutor(max_workers = max_workers) as pool:
+            results = list(pool.map(aux_map, fragments))
+    if all(isinstance(r, pa.Table) for r in results):
+        return pa.concat_tables(results, promote_options = 'default')
+    return results
+
+
+def load_sales(dir_read, stub = 'out', columns = None, filters = None,
+               map_func = None, max_workers = None):
+    """
+    Function: reads a slice of RetailReader.write_data sales output
+    Arguments:
+        dir_read: write_data directory, or the sales file / dataset itself
+        stub: file prefix used in write_data
+        columns: optional list of columns to read
+        filters: pyarrow expression, e.g.
+            (pc.field('panel_year') == 2012) & (pc.field('upc') == x),
+            or a pq-style list of tuples [('panel_year', '==', 2012)]
+        map_func: optional function applied to each fragment's table (one
+            per parquet row group) in parallel, e.g. an aggregation
+        max_workers: threads for map_func (default: pyarrow's choice)
+    Partition directories and row groups that cannot match the filter are
+    never read. Works on parquet (direct, clustered or hive-partitioned)
+    and ipc outputs.
+    """
+    return _scan_output(_output_dataset(dir_read, 'sales', stub), columns,
+                        filters, map_func, max_workers)
+
+
+def load_panel(dir_read, table = 'purchases', stub = 'out', columns = None,
+               filters = None, map_func = None, max_workers = None):
+    """
+    Function: reads a slice of a PanelReader.write_data output table
+    Arguments:
+        dir_read: write_data directory, or the output file itself
+        table: 'purchases', 'trips', 'panelists', 'products', 'variations',
+            'retailers' or 'extra'
+        stub, columns, filters, map_func, max_workers: as in load_sales
+    """
+    return _scan_output(_output_dataset(dir_read, table, stub), columns,
+                        filters, map_func, max_workers)
+
+
+def load_households(dir_read, codes, stub = 'out', years = None, columns = None):
+    """
+    Function: reads the purchases of selected households from a
+    PanelReader.write_data(by_household=True) output
+    Arguments:
+        dir_read: directory the data was written to
+        codes: list of household_code values
+        stub: file prefix used in write_data
+        years: optional list of panel years to keep
+        columns: optional list of columns to read
+    Only the row groups and row ranges listed in the household index
+    are read.
+    """
+    dir_read = path.Path(dir_read)
+    index = pq.read_table(dir_read / '{stub}_purchases_households.parquet'.format(stub=stub))
+    my_filter = pc.is_in(index['household_code'], value_set = pa.array(codes, pa.uint32()))
+    if years:
+        my_filter = pc.and_(my_filter, pc.is_in(index['panel_year'],
+                                                value_set = pa.array(years, pa.uint16())))
+    index = index.filter(my_filter).sort_by([('file', 'ascending'), ('row_group', 'ascending'),
+                                             ('row_start', 'ascending')])
+
+    parts = []
+    files = {}
+    cached = (None, None)
+    for entry in index.to_pylist():
+        if entry['file'] not in files:
+            files[entry['file']] = pq.ParquetFile(dir_read / entry['file'])
+        pf = files[entry['file']]
+        # read each row group once and slice out the household ranges
+        if cached[0] != (entry['file'], entry['row_group']):
+            cached = ((entry['file'], entry['row_group']),
+                      pf.read_row_group(entry['row_group'], columns = columns))
+        parts.append(cached[1].slice(entry['row_start'],
+                                     entry['row_end'] - entry['row_start']))
+
+    if not parts:
+        schema = pq.read_schema(dir_read / '{stub}_purchases.parquet'.format(stub=stub))
+        if columns is not None:
+            schema = pa.schema([schema.field(c) for c in columns])
+        return schema.empty_table()
+    return pa.concat_tables(parts)
+
 # %%
 
 # Define class RetailReader
@@ -550,7 +2154,9 @@ class RetailReader(object):
     Files created:
         df_extra: from annual product_extra files
         df_products: from Master product file
-        df_rms: from Annual rms_versions files
+        rms_resolver: sorted (upc, panel_year) -> upc_ver_uc lookup built
+            from the Annual rms_versions files
+        df_rms: the same versions as a table, expanded from rms_resolver on access
         df_stores: from Annual stores files
         df_sales: from Movement files
     Can filter based on store locations (DMAs), product groups,
@@ -560,13 +2166,21 @@ class RetailReader(object):
     # initialize object
     # input: directory from which to read in the Scanner Data
     # if no input, assume current working directory
-    def __init__(self, dir_read = path.Path.cwd(), verbose = True):
+    def __init__(self, dir_read = path.Path.cwd(), verbose = True,
+                 stats_callback = None, progress = None):
         """
         Function: initialize a RetailReader object
         identifies file names and locations for each dataset
         Will throw errors if any critical files are missing or incorrectly named
+        Optional: stats_callback: function called with every span recorded
+        in self.stats (see ReaderStats)
+        progress: a ProgressReporter, or a function called with each of its
+        updates; by default updates are printed when verbose
         """
         self.verbose = verbose
+        self.stats = ReaderStats(stats_callback)
+        self.progress = _progress_reporter(progress, verbose)
+        t_discover = time.perf_counter()
 
         self.dir_read = dir_read # save the folder to the class
 
@@ -638,18 +2252,56 @@ class RetailReader(object):
                                if get_year(f) == y]
                            for y in self.all_years}
 
+        # file sizes feed the progress reports
+        self.file_sizes = {f: _file_size(self, f) for f in self.files}
+
+        self.stats.record('discover', dir_read, time.perf_counter() - t_discover,
+                          files = len(self.files),
+                          bytes = sum(size or 0 for size in self.file_sizes.values()))
+
+        self._init_tables()
+
+        return
 
+    # tables saved by write_data and restored by load
+    OUTPUT_TABLES = ('sales', 'stores', 'products', 'extra')
 
+    def _init_tables(self):
         # Create empty DataFrames to store data as we process it
 
         self.df_products = pd.DataFrame()
         self.df_sales = pd.DataFrame()
         self.df_stores = pd.DataFrame()
-        self.df_rms = {}
+        self.rms_resolver = None
         self.df_extra = pd.DataFrame()
 
         return
 
+    @classmethod
+    def load(cls, dir_load, stub = 'out', dir_read = None, verbose = True):
+        """
+        Function: restores a RetailReader from write_data(format='ipc') output
+        Arguments:
+            dir_load: directory the data was written to
+            stub: file prefix used in write_data (default: 'out')
+            dir_read: optional raw Kilts directory; if given the reader is
+                initialized from it as usual, so the read* methods work
+            verbose: print progress
+        df_sales, df_stores, df_products and df_extra are memory-mapped
+        from [stub]_[table].arrow without copying (for uncompressed files).
+        """
+        if dir_read is not None:
+            reader = cls(dir_read, verbose = verbose)
+        else:
+            reader = cls.__new__(cls)
+            reader.verbose = verbose
+            reader.stats = ReaderStats()
+            reader.progress = _progress_reporter(None, verbose)
+            reader.dir_read = None
+            reader.file_sizes = {}
+            reader._init_tables()
+        return aux_load_ipc(reader, cls.OUTPUT_TABLES, dir_load, stub)
+
 
     # given the Path of a sales file, find its module code
     def get_module(self, file_sales):
@@ -761,9 +2413,9 @@ class RetailReader(object):
     # Begin READING Process
     # this is quite memory intensive!
     # make sure you have filtered years and sales as much as possible
-    def read_rms(self):
+    def read_rms(self, cache = None):
         """
-        Function: populates self.df_rms
+        Function: populates self.rms_resolver (and so self.df_rms)
 
         Read in the RMS versions files
         Some UPCs are reuses of UPCs from previous years
@@ -771,22 +2423,53 @@ class RetailReader(object):
         And codes these as a new product "version" in the later years
         Columns: upc, upc_ver_uc, panel_year
         See Nielsen documentation for a full description of these variables.
+
+        Optional: cache: path of an .npz file (used as given: no suffix
+        is added). If it exists and was built
+        from the same rms_versions files (years, paths and sizes), the
+        resolver is loaded from it instead of parsing the files; otherwise
+        it is (re)written there once built.
+
+        Only the resolver is kept in memory: df_rms is expanded from it
+        on access.
         """
+        source = [[y, str(f), self.file_sizes.get(f)] for y, f in sorted(self.dict_rms.items())]
+        if cache is not None and path.Path(cache).exists():
+            resolver = RmsResolver.load(cache)
+            if resolver.source == source:
+                self.rms_resolver = resolver
+                if self.verbose:
+                    print('Loaded RMS versions from', cache)
+                return
+            warnings.warn(f"RMS cache {cache} was built from other rms_versions files; rebuilding it",
+                          UserWarning, stacklevel=2)
+
         parse_opt = csv.ParseOptions(delimiter = '\t')
         # convert the types as needed
         conv_opt = csv.ConvertOptions(column_types = dict_types)
 
-        self.df_rms = pa.concat_tables(
-            [_read_csv(self, self.dict_rms[y], parse_options = parse_opt, convert_options = conv_opt)
-             for y in self.dict_rms.keys()]
-            )
+        def aux_read(f):
+            df = _read_csv(self, f, parse_options = parse_opt, convert_options = conv_opt)
+            _validate_columns(df.column_names, EXPECTED_RMS_COLS, "rms_versions")
+            return df
 
-        _validate_columns(self.df_rms.column_names, EXPECTED_RMS_COLS, "rms_versions")
+        self.rms_resolver = RmsResolver.from_tables(
+            (aux_read(self.dict_rms[y]) for y in self.dict_rms.keys()), source)
+        if cache is not None:
+            self.rms_resolver.save(cache)
 
         if self.verbose:
             print('Successfully Read in the RMS Files')
         return
 
+    @property
+    def df_rms(self):
+        """upc, upc_ver_uc, panel_year table expanded from rms_resolver
+        (built on each access; empty before read_rms)."""
+        if self.rms_resolver is None:
+            return RmsResolver(np.empty(0, np.uint64), np.empty(0, np.uint8)).to_table()
+        return self.rms_resolver.to_table()
+
     def read_products(self, upc_list=None,
                      keep_groups = None, drop_groups = None,
                      keep_modules = None, drop_modules = None,
@@ -945,6 +2628,64 @@ class RetailReader(object):
             print('Final Store Count: ', len(self.df_stores))
         return
 
+    # for each module-year, clean up the data frame
+    # optional: add_dates: calculate the month and quarter
+    def _clean_sales(self, df_tab, add_dates = False, filename = None, columns = None):
+        """
+        Add the read_sales columns to one module-year of Movement data:
+        week_end as a timestamp, unit_price, panel_year, revenue,
+        upc_ver_uc (from rms_resolver), the SALES_STORE_COLUMNS (from
+        df_stores) and, with add_dates, quarter and month.
+        columns: optional list of output columns; only these are computed
+        and joined, and they are returned in this order
+        (see SALES_COLUMN_SOURCES).
+        """
+        def want(*names):
+            return columns is None or any(n in columns for n in names)
+        store_cols = [c for c in SALES_STORE_COLUMNS if want(c)]
+
+        with self.stats.span('clean', filename):
+            # original format is 20050731
+            # NOTE different from the more formal year function (CC: not as far as I can tell)
+            if 'week_end' in df_tab.column_names:
+                df_tab = df_tab.set_column(df_tab.column_names.index('week_end'), 'week_end',
+                    pa.array(pd.to_datetime( df_tab['week_end'].to_numpy(), format = '%Y%m%d'),
+                    pa.timestamp('ns')))
+
+            fill_value = pa.scalar(-1, type=pa.int8())
+            for col in ('feature', 'display'):
+                if col in df_tab.column_names:
+                    df_tab = df_tab.set_column(df_tab.column_names.index(col), col,
+                                               pc.fill_null(df_tab[col], fill_value))
+
+            # Compute unit price and year and add upc_ver_uc
+            if want('unit_price', 'revenue'):
+                df_tab = df_tab.append_column('unit_price', pc.divide(df_tab['price'],df_tab['prmult']))
+            if want('panel_year', 'upc_ver_uc') or store_cols:
+                df_tab = df_tab.append_column('panel_year', pc.cast(pc.year(df_tab['week_end']),pa.uint16()))
+            if want('revenue'):
+                df_tab = df_tab.append_column('revenue', pc.multiply(df_tab['units'], df_tab['unit_price']))
+
+        if want('upc_ver_uc') or store_cols:
+            with self.stats.span('join', filename, rows_in = df_tab.num_rows) as span:
+                if want('upc_ver_uc'):
+                    df_tab = df_tab.append_column('upc_ver_uc',
+                        self.rms_resolver.lookup(df_tab['upc'], df_tab['panel_year']))
+                if store_cols:
+                    df_tab = df_tab.join(self.df_stores.select(['store_code_uc', 'panel_year'] + store_cols),
+                        keys=["store_code_uc","panel_year"],join_type='left outer')
+                span['rows_kept'] = df_tab.num_rows
+
+        if add_dates and want('quarter', 'month'):
+            with self.stats.span('clean', filename):
+                my_dates = _calendar_columns(df_tab['week_end'])
+                df_tab = df_tab.append_column('quarter', my_dates['quarter'].cast(pa.timestamp('ns')))
+                df_tab = df_tab.append_column('month', my_dates['month'].cast(pa.timestamp('ns')))
+
+        if columns is not None:
+            df_tab = df_tab.select([c for c in columns if c in df_tab.column_names])
+        return df_tab
+
     # Now, turn our attention to the Movement Files, i.e. the Sales
     # you should have already filtered the years that you want
     # NOTE: read only those sales corresponding to the filtered stores
@@ -970,45 +2711,11 @@ class RetailReader(object):
         if len(self.df_stores) == 0:
             self.read_stores()
 
-        if len(self.df_rms) ==0:
+        if self.rms_resolver is None:
             self.read_rms()
 
         # select columns
-        my_cols = ['store_code_uc', 'upc', 'week_end', 'units', 'prmult', 'price']
-
-        if incl_promo == True:
-            my_cols = my_cols + ['feature', 'display']
-
-        # for each module-year, clean up the data frame
-        # optional: add_dates: calculate the month and quarter        
-        def aux_clean(df_tab, add_dates=False):
-            # original format is 20050731
-            # NOTE different from the more formal year function (CC: not as far as I can tell)
-            df_tab = df_tab.set_column(2,'week_end', 
-                pa.array(pd.to_datetime( df_tab['week_end'].to_numpy(), format = '%Y%m%d'),
-                pa.timestamp('ns')))
-
-            if 'feature' in df_tab.schema.to_string():
-                fill_value = pa.scalar(-1, type=pa.int8())
-                df_tab = df_tab.set_column(6,'feature',pa.compute.fill_null(df_tab['feature'],fill_value))
-                df_tab = df_tab.set_column(7,'display',pa.compute.fill_null(df_tab['display'],fill_value))
-
-            # Compute unit price and year and add upc_ver_uc
-            df_tab = df_tab.append_column('unit_price', pc.divide(df_tab['price'],df_tab['prmult']))
-            df_tab = df_tab.append_column('panel_year', pc.cast(pc.year(df_tab['week_end']),pa.uint16()))
-            df_tab = df_tab.append_column('revenue', pa.compute.multiply(df_tab['units'], df_tab['unit_price']))
-
-            df_tab = df_tab.join(self.df_rms, keys=["upc","panel_year"],join_type='left outer')
-            df_tab = df_tab.join(self.df_stores.select(['store_code_uc','panel_year','dma_code','retailer_code','parent_code']),
-                keys=["store_code_uc","panel_year"],join_type='left outer')
-            
-            if add_dates:
-                my_dates=pd.DataFrame({'week_end':pa.compute.unique(df_tab['week_end']).to_pandas().sort_values(ignore_index=True)})
-                my_dates['quarter']=my_dates.week_end + pd.offsets.QuarterEnd(0)
-                my_dates['month']=my_dates['week_end'].astype('datetime64[M]')
-                df_tab=df_tab.join(pa.Table.from_pandas(my_dates,preserve_index=False), keys=["week_end"])
-
-            return df_tab
+        my_cols = _sales_read_columns(incl_promo)
 
         # have to read one module-year at a time
         # as a pandas table, which we will later concatenate
@@ -1019,19 +2726,26 @@ class RetailReader(object):
                                           include_columns = my_cols)
             # is a dataset object that can be turned into a table
             # but we can also filter immediately if we like
-            pa_my = pads.dataset(_read_csv(self, filename,
-                                              parse_options = parse_opt,
-                                              convert_options=conv_opt))
+            tab_raw = _read_csv(self, filename,
+                                parse_options = parse_opt,
+                                convert_options=conv_opt)
+            pa_my = pads.dataset(tab_raw)
 
             if list_stores is None:
-                pa_tab = aux_clean(pa_my.to_table(), add_dates)
+                pa_tab = self._clean_sales(pa_my.to_table(), add_dates, filename)
             else:
-                pa_tab = aux_clean(pa_my.to_table(filter=pads.field('store_code_uc').isin(list_stores)), add_dates)
+                with self.stats.span('filter', filename, rows_in = tab_raw.num_rows) as span:
+                    tab_kept = pa_my.to_table(filter=pads.field('store_code_uc').isin(list_stores))
+                    span['rows_kept'] = tab_kept.num_rows
+                del tab_raw, pa_my
+                pa_tab = self._clean_sales(tab_kept, add_dates, filename)
 
             if agg_function:
-                return agg_function(pa_tab, **kwargs)
-            else:
-                return pa_tab
+                pa_tab = agg_function(pa_tab, **kwargs)
+
+            if self.progress is not None:
+                self.progress.advance(filename.stem, *self.stats.file_rows([filename]))
+            return pa_tab
 
         # read all the modules (and groups) for one year
         def aux_read_year(year, add_dates, agg_function=None, **kwargs):
@@ -1049,8 +2763,12 @@ class RetailReader(object):
 
         if self.verbose == True:
             print('Reading Sales')
-            tick()
-        
+        t_start = time.perf_counter()
+        if self.progress is not None:
+            # one unit per module-year file, e.g. 1484_2012
+            self.progress.start('sales', {f.stem: [f] for y in self.dict_sales.keys()
+                                          for f in self.dict_sales[y]},
+                                self.file_sizes, 'module-years')
         
         # This does the work -- keep as PyArrow table
         self.df_sales = pa.concat_tables([aux_read_year(y, add_dates, agg_function, **kwargs) for y in self.dict_sales.keys()])
@@ -1059,11 +2777,16 @@ class RetailReader(object):
 
         if self.verbose == True:
             print('Finished Sales')
-            tock()
+            _print_elapsed(time.perf_counter() - t_start)
+
+        self._drop_unsold()
+        return
 
+    def _drop_unsold(self):
+        """Keep only the stores and products that appear in df_sales."""
         # NOTE: ORIGINAL CODE MERGES THIS WITH df_stores
         # # finally, drop the stores that have no sales
-        if 'store_code_uc' in self.df_sales.column_names:
+        if 'store_code_uc' in self.df_sales.column_names and isinstance(self.df_stores, pa.Table):
             self.df_stores = self.df_stores.filter(
                 pc.is_in(self.df_stores['store_code_uc'],
                 pc.unique(self.df_sales['store_code_uc'])))
@@ -1074,24 +2797,154 @@ class RetailReader(object):
             if isinstance(self.df_products, pa.Table):
                 self.df_products = self.df_products.filter(
                     pc.is_in(self.df_products['upc'], value_set=sales_upcs))
-            else:
+            elif not self.df_products.empty:
                 self.df_products = self.df_products[
                     self.df_products.upc.isin(sales_upcs.to_numpy())]
-
         return
 
+    def lazy(self):
+        """
+        Function: starts a lazy SalesPlan on this reader
+        filter_years, filter_sales, filter_stores, read_products and
+        read_sales on the plan only record steps; the plan is optimized and
+        run once by .collect() or .write(...). See SalesPlan.
+        """
+        return SalesPlan(self)
+
+    def estimate(self, incl_promo = True, add_dates = False, sample_files = 3,
+                 sample_bytes = 4 << 20, calibration = None):
+        """
+        Function: predicts the rows, Arrow memory and runtime of read_sales
+        without reading the Movement files in full
+        Arguments:
+            incl_promo, add_dates: as in read_sales (no agg_function)
+            sample_files: number of Movement files to sample, spread over
+                the selected module-years
+            sample_bytes: bytes parsed from the start of each sampled file
+            calibration: optional stats of an earlier run (a ReaderStats
+                such as another reader's self.stats, or its to_dict()). Its
+                seconds per byte replace the sampled parse rate, which
+                leaves out the join and clean stages.
+
+        Uses the Movement file sizes found at discovery (after filter_years
+        and filter_sales), the sampled rows per byte and Arrow bytes per
+        row, and the share of sampled rows from the stores in df_stores
+        (after filter_stores; all rows are kept if df_stores is not read).
+        Returns a dict:
+            files, bytes: Movement files to read and their size
+            rows_in: rows parsed; rows: rows kept in df_sales
+            arrow_bytes: size of df_sales
+            arrow_peak: Arrow memory in use while read_sales reads the
+                largest file, on top of what is allocated now
+            seconds: runtime of read_sales
+            calibrated: whether seconds come from calibration
+        After a real run, compare with self.stats.totals().
+        """
+        files = [f for y in self.dict_sales.keys() for f in self.dict_sales[y]]
+        sizes = [self.file_sizes.get(f) or _file_size(self, f) or 0 for f in files]
+
+        parse_opt = csv.ParseOptions(delimiter = '\t')
+        conv_opt = csv.ConvertOptions(column_types = dict_types,
+                                      include_columns = _sales_read_columns(incl_promo))
+        has_stores = isinstance(self.df_stores, pa.Table) and self.df_stores.num_rows > 0
+
+        rows = kept = sampled = raw_bytes = kept_bytes = 0
+        seconds = 0.0
+        for f in _spread(files, sample_files):
+            tab, n, sec = _sample_csv(self, f, sample_bytes,
+                                      parse_options = parse_opt, convert_options = conv_opt)
+            tab_kept = tab
+            if has_stores:
+                t0 = time.perf_counter()
+                stores = self.df_stores['store_code_uc'].filter(
+                    pc.equal(self.df_stores['panel_year'], get_year(f)))
+                tab_kept = tab.filter(pc.is_in(tab['store_code_uc'], value_set = stores))
+                sec += time.perf_counter() - t0
+            rows += tab.num_rows
+            kept += tab_kept.num_rows
+            sampled += n
+            raw_bytes += tab.nbytes
+            kept_bytes += tab_kept.nbytes
+            seconds += sec
+
+        # columns read_sales adds: unit_price, panel_year, revenue,
+        # upc_ver_uc, the store columns, week_end as a timestamp
+        added = [pa.float64(), pa.uint16(), pa.float64(), pa.uint8(),
+                 dict_types['dma_code'], dict_types['retailer_code'],
+                 dict_types['parent_code']]
+        if add_dates:
+            added += [pa.timestamp('ns'), pa.timestamp('ns')]
+        added_bytes = (sum(t.bit_width // 8 for t in added)
+                       + pa.timestamp('ns').bit_width // 8 - dict_types['week_end'].bit_width // 8)
+
+        rows_per_byte = rows / sampled if sampled else 0.0
+        keep = kept / rows if rows else 1.0
+        raw_per_row = raw_bytes / rows if rows else 0.0
+        out_per_row = (kept_bytes / kept if kept else raw_per_row) + added_bytes
+
+        total_bytes = sum(sizes)
+        rows_in = total_bytes * rows_per_byte
+        largest = max(sizes, default = 0) * rows_per_byte
+
+        rate = _calibrated_rate(calibration) if calibration is not None else None
+        calibrated = rate is not None
+        if rate is None:
+            rate = seconds / sampled if sampled else 0.0
+
+        estimate = {'files': len(files),
+                    'bytes': total_bytes,
+                    'rows_in': rows_in,
+                    'rows': rows_in * keep,
+                    'arrow_bytes': rows_in * keep * out_per_row,
+                    # df_sales so far plus the largest file parsed and cleaned
+                    'arrow_peak': (rows_in * keep * out_per_row + largest * raw_per_row
+                                   + largest * keep * out_per_row),
+                    'seconds': total_bytes * rate,
+                    'calibrated': calibrated}
+        if self.verbose:
+            _print_estimate(estimate)
+        return estimate
+
     def write_data(self, dir_write = path.Path.cwd(), stub = 'out',
                    compr = 'brotli', as_table = False,
-                   separator = 'panel_year'):
+                   separator = 'panel_year', max_workers = None,
+                   cluster_by = None, row_group_size = 1000000,
+                   max_rows_per_file = None, format = 'parquet'):
 
         """
         Function: writes data to parquet files
         Arguments:
             dir_write: Path to output directory (default: cwd)
             stub: prefix for output filenames (default: 'out')
-            compr: compression type (default: 'brotli')
-            as_table: if True, writes sales as a partitioned parquet dataset
-            separator: column on which to partition when as_table=True
+            compr: compression codec, or a profile from COMPRESSION_PROFILES
+                ('fast', 'balanced', 'archive') which also sets per-column
+                encodings (default: 'brotli')
+            as_table: if True, writes sales as a hive-partitioned parquet
+                dataset [stub]_sales/ with _metadata and _common_metadata
+                summary files
+            separator: column, or list of columns, on which to partition
+                when as_table=True, e.g. ['panel_year', 'product_group_code',
+                'product_module_code']; product columns are looked up from
+                df_products
+            max_workers: if > 1, write the tables concurrently in a thread
+                pool of this size (Arrow releases the GIL while encoding
+                and compressing)
+            cluster_by: optional list of columns to sort sales by before
+                writing, e.g.
+                ['product_module_code', 'upc', 'store_code_uc', 'week_end'];
+                product columns are looked up from df_products. A direct
+                write caps row groups at row_group_size rows and adds page
+                indexes and bloom filters on upc and store_code_uc, so
+                filtered reads can skip most of the file.
+            row_group_size: maximum rows per row group when clustering or
+                when as_table=True
+            max_rows_per_file: maximum rows per file when as_table=True
+                (default: no limit)
+            format: 'parquet' (default) or 'ipc', which writes each table to
+                an Arrow IPC file [stub]_[table].arrow for a fast reload with
+                RetailReader.load(); compr is then 'lz4' or 'zstd', anything
+                else writes uncompressed files that load without copying, and
+                the other layout options are ignored
 
         Note: will save all non-empty datasets
         i.e. any datasets for which the read* method has been applied
@@ -1104,29 +2957,333 @@ class RetailReader(object):
         if self.verbose == True:
             print('Writing to', dir_write)
 
+        if format == 'ipc':
+            _run_writes([(aux_write_ipc, (getattr(self, 'df_' + name),
+                                          path.Path(dir_write) / '{stub}_{n}.arrow'.format(stub=stub, n=name),
+                                          compr))
+                         for name in self.OUTPUT_TABLES], max_workers, self.stats)
+            return
+        elif format != 'parquet':
+            raise ValueError("format must be 'parquet' or 'ipc'")
+
         f_stores = self.dir_write / '{stub}_stores.parquet'.format(stub=stub)
         f_sales = self.dir_write /'{stub}_sales.parquet'.format(stub=stub)
         f_products = self.dir_write / '{stub}_products.parquet'.format(stub=stub)
         f_extra = self.dir_write /'{stub}_extra.parquet'.format(stub=stub)
 
-        aux_write_direct(self.df_stores, f_stores, compr=compr)
-        aux_write_direct(self.df_products, f_products, compr=compr)
-        aux_write_direct(self.df_extra, f_extra, compr=compr)
-
-        if as_table == False:
-            aux_write_direct(self.df_sales, f_sales, compr=compr)
-        else:
+        def aux_write_sales_dataset():
             dir_sales = self.dir_write / '{stub}_sales'.format(stub=stub)
+            partition_cols = [separator] if isinstance(separator, str) else list(separator)
+
+            # partition on product columns (e.g. product_module_code) too
+            df_sales = self.df_sales
+            for col, arr in _sales_columns(df_sales, partition_cols, self.df_products).items():
+                if col not in df_sales.column_names:
+                    df_sales = df_sales.append_column(col, arr)
+            order = None
+            if cluster_by:
+                order = _cluster_order(df_sales, cluster_by, self.df_products)
+
+            _write_hive_dataset(df_sales, dir_sales, partition_cols, compr = compr,
+                                max_rows_per_file = max_rows_per_file,
+                                row_group_size = row_group_size, order = order)
 
-            pq.write_to_dataset(self.df_sales,
-                root_path=dir_sales,
-                partition_cols=[separator],
-                compression=compr)
+            if self.verbose == True:
+                print('Wrote Dataset to {d} and partition {sep}'.format(d=dir_sales, sep=partition_cols))
+
+        def aux_write_sales_clustered():
+            order = _cluster_order(self.df_sales, cluster_by, self.df_products)
+            _write_clustered(self.df_sales, f_sales, order, cluster_by,
+                             compr = compr, row_group_size = row_group_size)
 
             if self.verbose == True:
-                print('Wrote Dataset to {d} and partition {sep}'.format(d=dir_sales, sep=separator))
+                print('Wrote sales clustered by {c} to {f}'.format(c=cluster_by, f=f_sales))
+
+        # largest table first so it starts writing right away
+        if as_table == False and cluster_by and isinstance(self.df_sales, pa.Table):
+            jobs = [(aux_write_sales_clustered, ())]
+        elif as_table == False:
+            jobs = [(aux_write_direct, (self.df_sales, f_sales, compr))]
+        elif isinstance(self.df_sales, pa.Table) and self.df_sales.num_rows > 0:
+            jobs = [(aux_write_sales_dataset, ())]
+        else:
+            jobs = []
+        jobs += [(aux_write_direct, (self.df_stores, f_stores, compr)),
+                 (aux_write_direct, (self.df_products, f_products, compr)),
+                 (aux_write_direct, (self.df_extra, f_extra, compr))]
+        _run_writes(jobs, max_workers, self.stats)
+        return
+
+class SalesPlan(object):
+    """
+    Lazy query plan over a RetailReader, started with RetailReader.lazy().
+
+    filter_years, filter_sales, filter_stores, read_products and read_sales
+    take the same arguments as the RetailReader methods but only record a
+    step and return the plan, so they can be chained in any order. Nothing
+    is read until collect() or write(). The optimizer then:
+        - applies the year, group and module filters to the Movement files
+          first, wherever they appear in the plan
+        - pushes the store filter into the scan: each Movement file is
+          streamed and only rows from the (filtered) stores of its year
+          are kept, as in read_sales
+        - reads only the Movement columns needed for the requested output
+          columns (see SALES_COLUMN_SOURCES), and skips the RMS read and
+          join when upc_ver_uc is not requested and the store join when no
+          store columns are; the stores are always read when sales are,
+          so as in read_sales only rows of each year's stores are kept
+        - reads stores, RMS versions and products concurrently, then the
+          Movement files in a thread pool
+    explain() describes the optimized plan without reading any data.
+    Running the plan leaves the reader in the state the same calls would:
+    the filters applied and df_sales, df_stores, df_products populated.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.steps = []
+
+    def _add(self, name, kwargs):
+        self.steps.append((name, kwargs))
+        return self
+
+    def filter_years(self, keep = None, drop = None):
+        """Deferred RetailReader.filter_years"""
+        return self._add('filter_years', dict(keep = keep, drop = drop))
+
+    def filter_sales(self, keep_groups = None, drop_groups = None,
+                     keep_modules = None, drop_modules = None):
+        """Deferred RetailReader.filter_sales"""
+        return self._add('filter_sales', dict(keep_groups = keep_groups, drop_groups = drop_groups,
+                                              keep_modules = keep_modules, drop_modules = drop_modules))
+
+    def filter_stores(self, keep_dmas = None, drop_dmas = None,
+                      keep_states = None, drop_states = None,
+                      keep_channels = None, drop_channels = None):
+        """Deferred RetailReader.filter_stores (reads the stores files when run)"""
+        return self._add('filter_stores', dict(keep_dmas = keep_dmas, drop_dmas = drop_dmas,
+                                               keep_states = keep_states, drop_states = drop_states,
+                                               keep_channels = keep_channels, drop_channels = drop_channels))
+
+    def read_products(self, upc_list = None,
+                      keep_groups = None, drop_groups = None,
+                      keep_modules = None, drop_modules = None,
+                      keep_departments = None, drop_departments = None):
+        """Deferred RetailReader.read_products"""
+        return self._add('read_products', dict(upc_list = upc_list,
+                                               keep_groups = keep_groups, drop_groups = drop_groups,
+                                               keep_modules = keep_modules, drop_modules = drop_modules,
+                                               keep_departments = keep_departments,
+                                               drop_departments = drop_departments))
+
+    def read_sales(self, incl_promo = True, add_dates = False, columns = None,
+                   agg_function = None, **kwargs):
+        """
+        Deferred RetailReader.read_sales
+        columns: optional list of df_sales columns to produce, e.g.
+        ['store_code_uc', 'upc', 'week_end', 'revenue']; by default all
+        read_sales columns
+        """
+        return self._add('read_sales', dict(incl_promo = incl_promo, add_dates = add_dates,
+                                            columns = columns, agg_function = agg_function,
+                                            kwargs = kwargs))
+
+    def _apply_file_filters(self, reader):
+        # year, group and module filters only select files: run them first
+        for name, kwargs in self.steps:
+            if name in ('filter_years', 'filter_sales'):
+                getattr(reader, name)(**kwargs)
+
+    def _resolve(self, reader):
+        """
+        Turn the steps into an optimized plan, for a reader whose file
+        filters are applied. Returns a dict:
+            files: [(year, Movement file)] to scan
+            sales, products: read_sales and read_products arguments (or None)
+            store_steps: filter_stores arguments, in order
+            stores: whether to read (and filter) the stores (always, with sales)
+            push_stores: whether to keep only rows of each year's stores
+            rms: whether upc_ver_uc is needed
+            columns: output columns; raw_columns: Movement columns to read
+        """
+        def last(name):
+            found = [kwargs for n, kwargs in self.steps if n == name]
+            return found[-1] if found else None
+
+        sales = last('read_sales')
+        store_steps = [kwargs for n, kwargs in self.steps if n == 'filter_stores']
+        stores_loaded = isinstance(reader.df_stores, pa.Table) and reader.df_stores.num_rows > 0
+        plan = {'files': [(y, f) for y in reader.dict_sales.keys() for f in reader.dict_sales[y]],
+                'sales': sales,
+                'products': last('read_products'),
+                'store_steps': store_steps,
+                'stores': bool(store_steps),
+                'push_stores': bool(store_steps) or stores_loaded,
+                'rms': False,
+                'columns': None,
+                'raw_columns': None}
+        if sales is None:
+            return plan
+
+        available = _sales_output_columns(sales['incl_promo'], sales['add_dates'])
+        columns = available if sales['columns'] is None else list(sales['columns'])
+        unknown = [c for c in columns if c not in available]
+        if unknown:
+            raise ValueError('Unknown sales columns {u}; available: {a}'.format(u=unknown, a=available))
+
+        # read_sales keeps only rows of each year's stores: always push them down
+        plan['stores'] = True
+        plan['push_stores'] = True
+        plan['rms'] = 'upc_ver_uc' in columns
+        sources = {src for c in columns for src in SALES_COLUMN_SOURCES.get(c, (c,))}
+        if plan['push_stores']:
+            sources.add('store_code_uc')
+        plan['columns'] = columns
+        plan['raw_columns'] = [c for c in _sales_read_columns(sales['incl_promo']) if c in sources]
+        return plan
+
+    def explain(self):
+        """Return a description of the optimized plan; reads no data."""
+        preview = copy.copy(self.reader)
+        preview.verbose = False
+        self._apply_file_filters(preview)
+        plan = self._resolve(preview)
+
+        nbytes = sum(preview.file_sizes.get(f) or 0 for _, f in plan['files'])
+        lines = ['SalesPlan',
+                 '  scan: {n} Movement files ({mb:.1f} MB), years {y}'.format(
+                     n=len(plan['files']), mb=nbytes / 1e6, y=sorted(preview.dict_sales.keys()))]
+        lookups = []
+        if plan['stores']:
+            steps = ['filter_stores'] * len(plan['store_steps'])
+            if not isinstance(preview.df_stores, pa.Table) or preview.df_stores.num_rows == 0:
+                steps.insert(0, 'read_stores')
+            if steps:
+                lookups.append(' + '.join(steps))
+        if plan['rms'] and preview.rms_resolver is None:
+            lookups.append('read_rms')
+        if plan['products'] is not None:
+            lookups.append('read_products')
+        if lookups:
+            lines.append('  lookups (concurrent): ' + ', '.join(lookups))
+        if plan['sales'] is not None:
+            lines.append('  read columns: ' + ', '.join(plan['raw_columns']))
+            if plan['push_stores']:
+                lines.append('  push down: store_code_uc in the stores of each year')
+            joins = []
+            if plan['rms']:
+                joins.append('upc_ver_uc from RMS versions')
+            store_cols = [c for c in plan['columns'] if c in SALES_STORE_COLUMNS]
+            if store_cols:
+                joins.append(', '.join(store_cols) + ' from stores')
+            lines.append('  join: ' + ('; '.join(joins) if joins else 'none'))
+            lines.append('  output: ' + ', '.join(plan['columns']))
+        return '\n'.join(lines)
+
+    def collect(self, max_workers = None):
+        """
+        Run the plan and return df_sales (None if the plan has no
+        read_sales step).
+        max_workers: threads for the concurrent steps and the Movement
+        files (default: the ThreadPoolExecutor default); 1 runs every step
+        in turn.
+        """
+        reader = self.reader
+        self._apply_file_filters(reader)
+        plan = self._resolve(reader)
+
+        def aux_stores():
+            if not isinstance(reader.df_stores, pa.Table) or reader.df_stores.num_rows == 0:
+                reader.read_stores()
+            for kwargs in plan['store_steps']:
+                reader.filter_stores(**kwargs)
+
+        # stores, RMS versions and products do not depend on each other
+        lookups = []
+        if plan['stores']:
+            lookups.append(aux_stores)
+        if plan['rms'] and reader.rms_resolver is None:
+            lookups.append(reader.read_rms)
+        if plan['products'] is not None:
+            lookups.append(lambda: reader.read_products(**plan['products']))
+        if max_workers == 1 or len(lookups) <= 1:
+            for func in lookups:
+                func()
+        else:
+            with ThreadPoolExecutor(max_workers = max_workers) as pool:
+                for future in [pool.submit(func) for func in lookups]:
+                    future.result()
+
+        sales = plan['sales']
+        if sales is None:
+            return None
+        if not plan['files']:
+            raise ValueError('No Movement files left after filter_years and filter_sales')
+
+        store_sets = {}
+        if plan['push_stores']:
+            store_sets = {y: _KeySet(reader.df_stores['store_code_uc'].filter(
+                              pc.equal(reader.df_stores['panel_year'], y)))
+                          for y in reader.dict_sales.keys()}
+
+        parse_opt = csv.ParseOptions(delimiter = '\t')
+        conv_opt = csv.ConvertOptions(column_types = dict_types,
+                                      include_columns = plan['raw_columns'])
+
+        def aux_read(year, filename):
+            batch_filter = None
+            if plan['push_stores']:
+                stores = store_sets[year]
+                batch_filter = lambda batch: stores.contains(batch['store_code_uc'])
+            df_tab = _scan_csv(reader, filename, batch_filter,
+                               parse_options = parse_opt, convert_options = conv_opt)
+            df_tab = reader._clean_sales(df_tab, sales['add_dates'], filename, plan['columns'])
+            if sales['agg_function']:
+                df_tab = sales['agg_function'](df_tab, **sales['kwargs'])
+            return df_tab
+
+        if reader.verbose:
+            print('Reading Sales')
+        t_start = time.perf_counter()
+        if reader.progress is not None:
+            reader.progress.start('sales', {f.stem: [f] for _, f in plan['files']},
+                                  reader.file_sizes, 'module-years')
+
+        def aux_done(filename):
+            if reader.progress is not None:
+                reader.progress.advance(filename.stem, *reader.stats.file_rows([filename]))
+
+        tables = []
+        if max_workers == 1:
+            for year, filename in plan['files']:
+                tables.append(aux_read(year, filename))
+                aux_done(filename)
+        else:
+            with ThreadPoolExecutor(max_workers = max_workers) as pool:
+                futures = [pool.submit(aux_read, year, filename) for year, filename in plan['files']]
+                for (year, filename), future in zip(plan['files'], futures):
+                    tables.append(future.result())
+                    aux_done(filename)
+
+        reader.df_sales = pa.concat_tables(tables)
+        if reader.verbose:
+            print('Finished Sales')
+            _print_elapsed(time.perf_counter() - t_start)
+
+        reader._drop_unsold()
+        return reader.df_sales
+
+    def write(self, dir_write = path.Path.cwd(), stub = 'out', max_workers = None, **kwargs):
+        """
+        Run the plan (see collect) and write the tables with
+        RetailReader.write_data; kwargs go to write_data.
+        """
+        self.collect(max_workers)
+        self.reader.write_data(path.Path(dir_write), stub = stub,
+                               max_workers = max_workers, **kwargs)
         return
 
+
 # %% Defining the PanelReader class
 class PanelReader(object):
     """
@@ -1142,13 +3299,21 @@ class PanelReader(object):
     Many filtering options available
 
     """
-    def __init__(self, dir_read = path.Path.cwd(), verbose = True):
+    def __init__(self, dir_read = path.Path.cwd(), verbose = True,
+                 stats_callback = None, progress = None):
         """
         Function: initialize a PanelReader object
         identifies file names and locations for each dataset
         Will throw errors if any critical files are missing or incorrectly named
+        Optional: stats_callback: function called with every span recorded
+        in self.stats (see ReaderStats)
+        progress: a ProgressReporter, or a function called with each of its
+        updates; by default updates are printed when verbose
         """
         self.verbose = verbose
+        self.stats = ReaderStats(stats_callback)
+        self.progress = _progress_reporter(progress, verbose)
+        t_discover = time.perf_counter()
 
         self.dir_read = dir_read
         self.files = get_files(self)
@@ -1216,7 +3381,27 @@ class PanelReader(object):
                                if get_year(f) == y]
                                for y in self.all_years}
 
+        # file sizes feed the progress reports
+        self.file_sizes = {f: _file_size(self, f) for f in self.files}
+
+        self.stats.record('discover', dir_read, time.perf_counter() - t_discover,
+                          files = len(self.files),
+                          bytes = sum(size or 0 for size in self.file_sizes.values()))
+
+        self._init_tables()
+
+        # NOTE some of these are repeats from RR
+        # we will therefore append _panel to file names
+
+        # NOTE skipping the cols_hh, cols_prod thing
+
+        return
+
+    # tables saved by write_data and restored by load
+    OUTPUT_TABLES = ('purchases', 'trips', 'panelists', 'products',
+                     'variations', 'retailers', 'extra')
 
+    def _init_tables(self):
         self.df_products = pd.DataFrame()
         self.df_variations = pd.DataFrame()
         self.df_retailers = pd.DataFrame()
@@ -1227,12 +3412,39 @@ class PanelReader(object):
 
         self.df_extra = pd.DataFrame()
 
-        # NOTE some of these are repeats from RR
-        # we will therefore append _panel to file names
-
-        # NOTE skipping the cols_hh, cols_prod thing
-
+        # cached UPC key set for filtering purchases, see _product_upc_set
+        self._upc_set_source = None
+        self._upc_set = None
+        # cached product lookup index, see _product_index
+        self._product_index_source = None
+        self._product_index_cache = None
         return
+
+    @classmethod
+    def load(cls, dir_load, stub = 'out', dir_read = None, verbose = True):
+        """
+        Function: restores a PanelReader from write_data(format='ipc') output
+        Arguments:
+            dir_load: directory the data was written to
+            stub: file prefix used in write_data (default: 'out')
+            dir_read: optional raw Kilts directory; if given the reader is
+                initialized from it as usual, so the read* methods work
+            verbose: print progress
+        Purchases, trips, panelists, products, variations, retailers and
+        extra are memory-mapped from [stub]_[table].arrow without copying
+        (for uncompressed files).
+        """
+        if dir_read is not None:
+            reader = cls(dir_read, verbose = verbose)
+        else:
+            reader = cls.__new__(cls)
+            reader.verbose = verbose
+            reader.stats = ReaderStats()
+            reader.progress = _progress_reporter(None, verbose)
+            reader.dir_read = None
+            reader.file_sizes = {}
+            reader._init_tables()
+        return aux_load_ipc(reader, cls.OUTPUT_TABLES, dir_load, stub)
     
     # Begin a Proper Cleanup: filter years, groups, modules, etc.
     def filter_years(self, keep = None, drop = None):
@@ -1420,16 +3632,61 @@ class PanelReader(object):
         return
 
 
+    def _product_upc_set(self):
+        """
+        Return a _KeySet of the UPCs in df_products, or None if products
+        have not been read. Cached until df_products is replaced.
+        """
+        if self._upc_set_source is self.df_products:
+            return self._upc_set
+
+        if isinstance(self.df_products, pa.Table) and self.df_products.num_rows > 0:
+            upc_set = _KeySet(self.df_products['upc'])
+        elif isinstance(self.df_products, pd.DataFrame) and not self.df_products.empty:
+            upc_set = _KeySet(pa.array(self.df_products['upc'].to_numpy(), pa.uint64()))
+        else:
+            upc_set = None
+
+        self._upc_set_source = self.df_products
+        self._upc_set = upc_set
+        return upc_set
+
     def read_year(self, year, keep_dmas = None, drop_dmas = None,
-        keep_states = None, drop_states = None, keep_stores=None, add_household=False):
+        keep_states = None, drop_states = None, keep_stores=None, add_household=False,
+        add_trip_info=False, add_dates=False):
         """
         Function: reads a single year of panel data (an auxiliary method)
         Arguments: required: year
         optional: keep_states, drop_states: list of states in two-letter format
         keep_dmas, drop_dmas: list of DMA codes
+        add_household: attach household_code from trips to purchases
+        add_trip_info: attach purchase_date, retailer_code and store_code_uc
+        from trips to purchases (and week_end, with add_dates)
+        add_dates: parse purchase_date to a date and add the scanner
+        week_end (Saturday), month and quarter columns to trips
 
         See Nielsen documentation for a full description of these variables.        
 
+        """
+        df_panelists, df_trips, df_purchases = self._read_year_tables(
+            year, keep_dmas = keep_dmas, drop_dmas = drop_dmas,
+            keep_states = keep_states, drop_states = drop_states,
+            keep_stores = keep_stores, add_household = add_household,
+            add_trip_info = add_trip_info, add_dates = add_dates)
+
+        # add to the list
+        self.df_trips.append(df_trips)
+        self.df_purchases.append(df_purchases)
+        self.df_panelists.append(df_panelists)
+
+        return
+
+    def _read_year_tables(self, year, keep_dmas = None, drop_dmas = None,
+        keep_states = None, drop_states = None, keep_stores=None, add_household=False,
+        add_trip_info=False, add_dates=False):
+        """
+        Read one year of panel data and return (df_panelists, df_trips,
+        df_purchases) without storing them; see read_year for arguments
         """
         try:
             f_trips = self.dict_trips[year][0]
@@ -1450,87 +3707,85 @@ class PanelReader(object):
         conv_opt = csv.ConvertOptions(column_types = dict_types,
                                       auto_dict_encode = True,
                                       auto_dict_max_cardinality = 1024)
-        ds_panelists = pads.dataset(_read_csv(self, f_panelists,
-                                                 parse_options = parse_opt,
-                                                 convert_options = conv_opt))
+        tab_panelists = _read_csv(self, f_panelists,
+                                  parse_options = parse_opt,
+                                  convert_options = conv_opt)
+        ds_panelists = pads.dataset(tab_panelists)
 
-        panelist_filter = pads.field('Projection_Factor') > 0
-
-        if keep_states:
-            panelist_filter = panelist_filter & (pads.field('Fips_State_Desc'
-                                                            ).isin(keep_states))
-        if drop_states:
-            panelist_filter = panelist_filter & (~pads.field('Fips_State_Desc'
-                                                             ).isin(drop_states))
-        if keep_dmas:
-            panelist_filter = panelist_filter & (pads.field('DMA_Cd').isin(keep_dmas))
-        
-        if drop_dmas:
-            panelist_filter = panelist_filter & (~pads.field('DMA_Cd').isin(drop_dmas))
+        panelist_filter = _panelist_filter(keep_states, drop_states, keep_dmas, drop_dmas)
 
         # Get the Panelist Table Filtered
-        df_panelists = ds_panelists.to_table(filter = panelist_filter)
+        with self.stats.span('filter', f_panelists, rows_in = tab_panelists.num_rows) as span:
+            df_panelists = ds_panelists.to_table(filter = panelist_filter)
+            span['rows_kept'] = df_panelists.num_rows
+        del tab_panelists, ds_panelists
         _validate_columns(df_panelists.column_names, EXPECTED_PANELIST_COLS,
                           f"panelists ({year})")
         col_names = [x if x not in dict_column_map else dict_column_map[x] for x in df_panelists.column_names]
         df_panelists = df_panelists.rename_columns(col_names)
 
         # Get a list of Unique HH
-        trip_filter = pads.field('household_code').isin(pc.unique(df_panelists['household_code']).to_pylist())
+        households = _KeySet(df_panelists['household_code'])
+        trip_filter = pads.field('household_code').isin(households.values)
 
         if keep_stores:
             trip_filter = trip_filter & pads.field('store_code_uc').isin(keep_stores)
 
-        df_trips = pads.dataset(_read_csv(self, f_trips,
-                    parse_options = parse_opt,
-                    convert_options = conv_opt)
-                    ).to_table(filter = trip_filter)
+        tab_trips = _read_csv(self, f_trips,
+                              parse_options = parse_opt,
+                              convert_options = conv_opt)
+        with self.stats.span('filter', f_trips, rows_in = tab_trips.num_rows) as span:
+            df_trips = pads.dataset(tab_trips).to_table(filter = trip_filter)
+            span['rows_kept'] = df_trips.num_rows
+        del tab_trips
         _validate_columns(df_trips.column_names, EXPECTED_TRIP_COLS,
                           f"trips ({year})")
 
-        # Get unique UPCs from products to filter purchases (if products were read)
-        has_products = (isinstance(self.df_products, pa.Table) and self.df_products.num_rows > 0) or \
-                       (isinstance(self.df_products, pd.DataFrame) and not self.df_products.empty)
-
-        trip_filter_purchases = pads.field('trip_code_uc').isin(df_trips['trip_code_uc'].to_numpy())
-
-        if has_products:
-            if isinstance(self.df_products, pa.Table):
-                unique_upcs = pc.unique(self.df_products['upc']).to_pylist()
-            else:
-                unique_upcs = self.df_products['upc'].unique().tolist()
-            purchase_filter = trip_filter_purchases & pads.field('upc').isin(unique_upcs)
-        else:
-            purchase_filter = trip_filter_purchases
-
-        ds_purchases = pads.dataset(_read_csv(self, f_purchases,
-                    parse_options = parse_opt,
-                    convert_options = conv_opt))\
-                    .to_table(filter = purchase_filter)
+        # parse purchase_date and align trips to the scanner calendar
+        if add_dates:
+            with self.stats.span('clean', f_trips):
+                df_trips = _add_trip_dates(df_trips)
+
+        # Key sets for the purchase semi-join: trips from this year,
+        # UPCs from df_products (built once and reused across years)
+        trip_codes = _KeySet(df_trips['trip_code_uc'])
+        unique_upcs = self._product_upc_set()
+
+        # stream the purchases file and keep only rows for the selected
+        # trips (and UPCs), so the unfiltered file is never in memory
+        def purchase_filter(batch):
+            mask = trip_codes.contains(batch['trip_code_uc'])
+            if unique_upcs is not None:
+                mask = pc.and_(mask, unique_upcs.contains(batch['upc']))
+            return mask
+
+        # fix the types that would otherwise be inferred from the first block
+        conv_opt_purchases = csv.ConvertOptions(
+            column_types = {**dict_types, **dict_purchase_types},
+            auto_dict_encode = True,
+            auto_dict_max_cardinality = 1024)
+        ds_purchases = _scan_csv(self, f_purchases, purchase_filter,
+                                 parse_options = parse_opt,
+                                 convert_options = conv_opt_purchases)
         _validate_columns(ds_purchases.column_names, EXPECTED_PURCHASE_COLS,
                           f"purchases ({year})")
 
-        df_purchases = ds_purchases.append_column('panel_year', pa.array([year]*ds_purchases.num_rows,pa.int16()))
+        df_purchases = ds_purchases.append_column('panel_year', pa.array(np.full(ds_purchases.num_rows, year, np.int16)))
 
-        # Going through numpy and pandas map cannot be fastest solution here
-        if add_household:
-            df_purchases=df_purchases.join(df_trips.select(['trip_code_uc','household_code']), keys=['trip_code_uc'])
+        # attach trip columns by position lookup in the sorted trip index
+        trip_cols = _purchase_trip_columns(add_household, add_trip_info, add_dates)
+        if trip_cols:
+            with self.stats.span('join', f_purchases, rows_in = df_purchases.num_rows,
+                                 rows_kept = df_purchases.num_rows):
+                df_purchases = _SortedIndex(df_trips, 'trip_code_uc', trip_cols).enrich(df_purchases, trip_cols)
 
-        # add to the list
-        self.df_trips.append(df_trips)
-        self.df_purchases.append(df_purchases)
-        self.df_panelists.append(df_panelists)
-
-        # pd.concat([self.df_panelists, df_panelists.copy()], ignore_index = True)
-
-        return
-        # need to have already read in products?
-        # but our version of products has no differences
-        #unique_upc = self.df_products['upc'].unique()
+        return df_panelists, df_trips, df_purchases
 
 
     def read_annual(self, keep_states = None, drop_states = None,
-                    keep_dmas = None, drop_dmas = None, keep_stores=None, add_household=False):
+                    keep_dmas = None, drop_dmas = None, keep_stores=None, add_household=False,
+                    add_trip_info=False, add_dates=False, max_workers = None,
+                    sink = None, stub = 'out', compr = 'brotli'):
         """
         Function: populates all annual datasets, except df_extra:
             df_panelists
@@ -1540,23 +3795,48 @@ class PanelReader(object):
         Arguments: optional: keep_states, drop_states, keep_dmas, drop_dmas:
             keeps households in the selected states and DMAs
             states taken in two-letter codes; DMAs follow Nielsen codes
+            add_household, add_trip_info, add_dates: attach trip columns
+            to purchases and calendar columns to trips (see read_year)
+            max_workers: if > 1, read years in a process pool of this size.
+            Each worker hands its tables back as Arrow IPC files, and the
+            results are concatenated in year order.
+            sink: optional directory. Each year's panelists, trips and
+            purchases are written to [sink]/[stub]_[table]/panel_year=[year]/
+            as soon as the year is read (with compression compr) instead of
+            being kept in memory. Existing [stub]_[table] directories are
+            replaced. Afterwards df_panelists, df_trips and df_purchases are
+            lazy pyarrow datasets over the sink, with an explicit schema
+            unified across years (also saved as _common_metadata);
+            call .to_table(filter=...) to materialize a slice.
 
         See Nielsen documentation for a full description of these variables.        
 
         """
-
-        # read in all the years
-
-        for year in self.all_years:
-            print('Processing Year', year)
-            tick()
-            self.read_year(year, keep_states = keep_states,
+        year_kwargs = dict(keep_states = keep_states,
                            drop_states = drop_states,
                            keep_dmas = keep_dmas,
                            drop_dmas = drop_dmas,
                            keep_stores = keep_stores,
-                           add_household= add_household)
-            tock()
+                           add_household = add_household,
+                           add_trip_info = add_trip_info,
+                           add_dates = add_dates)
+
+        self._progress_years(sorted(self.all_years))
+        if sink is not None:
+            self._read_years_to_sink(sorted(self.all_years), year_kwargs, sink,
+                                     stub, compr, max_workers)
+            return
+
+        # read in all the years
+        if max_workers is not None and max_workers > 1:
+            self._read_years_parallel(sorted(self.all_years), year_kwargs, max_workers)
+        else:
+            for year in sorted(self.all_years):
+                print('Processing Year', year)
+                t_year = time.perf_counter()
+                self.read_year(year, **year_kwargs)
+                _print_elapsed(time.perf_counter() - t_year)
+                self._progress_year(year)
 
         # Filter products for only those in sales data
         #self.df_products = self.df_products[self.df_products.upc.isin(pa.concat_tables(self.df_purchases).select(['upc'])['upc'].to_numpy())]
@@ -1569,9 +3849,668 @@ class PanelReader(object):
         return
 
 
+    def estimate(self, keep_states = None, drop_states = None,
+                 keep_dmas = None, drop_dmas = None, keep_stores = None,
+                 add_household = False, add_trip_info = False, add_dates = False,
+                 sample_files = 3, sample_bytes = 4 << 20, calibration = None):
+        """
+        Function: predicts the rows, Arrow memory and runtime of read_annual
+        without reading the Annual files in full
+        Arguments:
+            keep_states, drop_states, keep_dmas, drop_dmas, keep_stores,
+            add_household, add_trip_info, add_dates: as in read_annual
+            sample_files: number of years to sample, spread over the
+                selected years
+            sample_bytes: bytes parsed from the start of each sampled
+                panelists, trips and purchases file
+            calibration: optional stats of an earlier run (a ReaderStats
+                such as another reader's self.stats, or its to_dict()). Its
+                seconds per byte replace the sampled parse rate.
+
+        Uses the file sizes found at discovery (after filter_years) and
+        the sampled rows per byte and Arrow bytes per row. The household
+        filters are applied to the sampled panelists, keep_stores to the
+        sampled trips and the UPCs of df_products (if read) to the sampled
+        purchases. Trips and purchases are assumed to be kept in the same
+        share as households.
+        Returns a dict with, for 'panelists', 'trips' and 'purchases',
+        {'files', 'bytes', 'rows_in', 'rows', 'arrow_bytes'}, and totals:
+            files, bytes, rows_in, rows, arrow_bytes: summed over the tables
+            arrow_peak: Arrow memory in use at the end of read_annual's
+                largest year, on top of what is allocated now
+            year_peak: Arrow memory of reading the largest year alone, as
+                in a max_workers process or with sink
+            seconds: runtime of read_annual
+            calibrated: whether seconds come from calibration
+        After a real run, compare with self.stats.totals().
+        """
+        names = ('panelists', 'trips', 'purchases')
+        dicts = {'panelists': self.dict_panelists, 'trips': self.dict_trips,
+                 'purchases': self.dict_purchases}
+        years = [y for y in sorted(self.all_years) if all(dicts[n].get(y) for n in names)]
+
+        parse_opt = csv.ParseOptions(delimiter = '\t')
+        conv_opt = csv.ConvertOptions(column_types = dict_types,
+                                      auto_dict_encode = True,
+                                      auto_dict_max_cardinality = 1024)
+        conv_opt_purchases = csv.ConvertOptions(
+            column_types = {**dict_types, **dict_purchase_types},
+            auto_dict_encode = True,
+            auto_dict_max_cardinality = 1024)
+        panelist_filter = _panelist_filter(keep_states, drop_states, keep_dmas, drop_dmas)
+        trip_cols = _purchase_trip_columns(add_household, add_trip_info, add_dates)
+        unique_upcs = self._product_upc_set()
+
+        # per table: rows parsed, bytes sampled, Arrow bytes parsed,
+        # expected rows kept and their Arrow bytes
+        sample = {name: {'rows': 0, 'sampled': 0, 'raw_bytes': 0,
+                         'kept': 0.0, 'kept_bytes': 0.0} for name in names}
+        seconds = 0.0
+
+        def aux_sample(name, year, opt):
+            tab, n, sec = _sample_csv(self, dicts[name][year][0], sample_bytes,
+                                      parse_options = parse_opt, convert_options = opt)
+            sample[name]['rows'] += tab.num_rows
+            sample[name]['sampled'] += n
+            sample[name]['raw_bytes'] += tab.nbytes
+            return tab, sec
+
+        def aux_keep(name, rows, share, bytes_per_row):
+            sample[name]['kept'] += rows * share
+            sample[name]['kept_bytes'] += rows * share * bytes_per_row
+
+        for year in _spread(years, sample_files):
+            tab, sec = aux_sample('panelists', year, conv_opt)
+            t0 = time.perf_counter()
+            kept = pads.dataset(tab).to_table(filter = panelist_filter)
+            seconds += sec + time.perf_counter() - t0
+            households = kept.num_rows / tab.num_rows if tab.num_rows else 1.0
+            aux_keep('panelists', tab.num_rows, households,
+                     kept.nbytes / kept.num_rows if kept.num_rows else 0.0)
+
+            tab, sec = aux_sample('trips', year, conv_opt)
+            t0 = time.perf_counter()
+            kept = tab
+            if keep_stores:
+                kept = pads.dataset(tab).to_table(filter = pads.field('store_code_uc').isin(keep_stores))
+            if add_dates:
+                kept = _add_trip_dates(kept)
+            seconds += sec + time.perf_counter() - t0
+            stores = kept.num_rows / tab.num_rows if tab.num_rows else 1.0
+            trips_per_row = kept.nbytes / kept.num_rows if kept.num_rows else 0.0
+            trip_col_bytes = (kept.select(trip_cols).nbytes / kept.num_rows
+                              if trip_cols and kept.num_rows else 0.0)
+            aux_keep('trips', tab.num_rows, households * stores, trips_per_row)
+
+            tab, sec = aux_sample('purchases', year, conv_opt_purchases)
+            t0 = time.perf_counter()
+            kept = tab
+            if unique_upcs is not None:
+                kept = tab.filter(unique_upcs.contains(tab['upc']))
+            seconds += sec + time.perf_counter() - t0
+            upcs = kept.num_rows / tab.num_rows if tab.num_rows else 1.0
+            # plus panel_year (int16) and the attached trip columns
+            aux_keep('purchases', tab.num_rows, households * stores * upcs,
+                     (kept.nbytes / kept.num_rows if kept.num_rows else 0.0)
+                     + 2 + trip_col_bytes)
+
+        # per table: rows per byte, share kept, Arrow bytes per row
+        rates = {}
+        for name, smp in sample.items():
+            rates[name] = (smp['rows'] / smp['sampled'] if smp['sampled'] else 0.0,
+                           smp['kept'] / smp['rows'] if smp['rows'] else 1.0,
+                           smp['raw_bytes'] / smp['rows'] if smp['rows'] else 0.0,
+                           smp['kept_bytes'] / smp['kept'] if smp['kept'] else 0.0)
+
+        estimate = {name: {'files': 0, 'bytes': 0, 'rows_in': 0.0, 'rows': 0.0,
+                           'arrow_bytes': 0.0} for name in names}
+        year_peak = transient_peak = 0.0
+        for year in years:
+            predicted = {}
+            for name in names:
+                size = self.file_sizes.get(dicts[name][year][0]) or _file_size(self, dicts[name][year][0]) or 0
+                rows_per_byte, keep, raw_per_row, out_per_row = rates[name]
+                rows_in = size * rows_per_byte
+                predicted[name] = (rows_in * raw_per_row, rows_in * keep * out_per_row)
+                table = estimate[name]
+                table['files'] += 1
+                table['bytes'] += size
+                table['rows_in'] += rows_in
+                table['rows'] += rows_in * keep
+                table['arrow_bytes'] += rows_in * keep * out_per_row
+            # while a year is read: the raw panelists and trips, and the
+            # purchases before the trip columns are attached
+            transient = (predicted['panelists'][0] + predicted['trips'][0]
+                         + predicted['purchases'][1])
+            transient_peak = max(transient_peak, transient)
+            year_peak = max(year_peak, transient + sum(predicted[name][1] for name in names))
+
+        total_bytes = sum(estimate[name]['bytes'] for name in names)
+        sampled = sum(smp['sampled'] for smp in sample.values())
+        rate = _calibrated_rate(calibration) if calibration is not None else None
+        calibrated = rate is not None
+        if rate is None:
+            rate = seconds / sampled if sampled else 0.0
+
+        arrow_bytes = sum(estimate[name]['arrow_bytes'] for name in names)
+        estimate.update({'files': sum(estimate[name]['files'] for name in names),
+                         'bytes': total_bytes,
+                         'rows_in': sum(estimate[name]['rows_in'] for name in names),
+                         'rows': sum(estimate[name]['rows'] for name in names),
+                         'arrow_bytes': arrow_bytes,
+                         'arrow_peak': arrow_bytes + transient_peak,
+                         'year_peak': year_peak,
+                         'seconds': total_bytes * rate,
+                         'calibrated': calibrated})
+        if self.verbose:
+            _print_estimate(estimate)
+        return estimate
+
+    def _year_files(self, year):
+        """Panelists, trips and purchases files of one year."""
+        return (self.dict_panelists.get(year, []) + self.dict_trips.get(year, [])
+                + self.dict_purchases.get(year, []))
+
+    def _progress_years(self, years):
+        """Start a progress task with one unit per year."""
+        if self.progress is not None:
+            self.progress.start('panel', {year: self._year_files(year) for year in years},
+                                self.file_sizes, 'years')
+
+    def _progress_year(self, year):
+        """Report a finished year, with rows from its stats spans."""
+        if self.progress is not None:
+            self.progress.advance(year, *self.stats.file_rows(self._year_files(year)))
+
+    def _iter_years(self, **kwargs):
+        """
+        Yield (year, df_panelists, df_trips, df_purchases) one year at a time.
+        Slices the tables from read_annual if it has run (or reads one year
+        partition of its sink); otherwise reads each year from the files
+        (kwargs go to read_year) without storing it.
+        If the loaded tables hold no purchases, a single empty year
+        (panel_year 0) is yielded so callers still build correctly typed
+        empty outputs.
+        """
+        if isinstance(self.df_purchases, pads.Dataset):
+            # read_annual(sink=...): read one year partition at a time
+            years = pc.unique(self.df_purchases.to_table(columns = ['panel_year'])['panel_year'])
+            for year in sorted(years.to_pylist()):
+                expr = pc.field('panel_year') == year
+                yield (year, self.df_panelists.to_table(filter = expr),
+                       self.df_trips.to_table(filter = expr),
+                       self.df_purchases.to_table(filter = expr))
+            if len(years) == 0:
+                yield (0, self.df_panelists.schema.empty_table(),
+                       self.df_trips.schema.empty_table(),
+                       self.df_purchases.schema.empty_table())
+            return
+
+        loaded = isinstance(self.df_purchases, pa.Table)
+        if loaded:
+            # the years present in the data (also works after load())
+            years = pc.unique(self.df_purchases['panel_year']).to_pylist()
+            if not years:
+                yield (0, self.df_panelists.slice(0, 0), self.df_trips.slice(0, 0),
+                       self.df_purchases.slice(0, 0))
+                return
+        else:
+            years = self.all_years
+            if not years:
+                raise ValueError('No panel years left to read: check filter_years()')
+        for year in sorted(years):
+            if loaded:
+                yield (year,
+                       self.df_panelists.filter(pc.equal(self.df_panelists['panel_year'], year)),
+                       self.df_trips.filter(pc.equal(self.df_trips['panel_year'], year)),
+                       self.df_purchases.filter(pc.equal(self.df_purchases['panel_year'], year)))
+            else:
+                if self.verbose:
+                    print('Processing Year', year)
+                yield (year, *self._read_year_tables(year, **kwargs))
+
+    def _product_index(self):
+        """
+        Return a _SortedIndex of df_products on (upc, upc_ver_uc).
+        Cached until df_products is replaced.
+        """
+        if self._product_index_source is self.df_products:
+            return self._product_index_cache
+
+        df_products = self.df_products
+        if isinstance(df_products, pd.DataFrame):
+            if df_products.empty:
+                raise ValueError('Run read_products() before grouping on product columns')
+            df_products = pa.Table.from_pandas(df_products, preserve_index=False)
+        keys = _composite_key(df_products['upc'].to_numpy(),
+                              df_products['upc_ver_uc'].to_numpy())
+
+        self._product_index_source = self.df_products
+        self._product_index_cache = _SortedIndex(df_products, 'upc', key_values=keys)
+        return self._product_index_cache
+
+    def _purchase_frame(self, year, df_panelists, df_trips, df_purchases, by,
+                        period = None, weight = 'Projection_Factor'):
+        """
+        Build a narrow table for one year with one row per purchase:
+        panel_year, household_code, trip_code_uc, weight, spend, quantity,
+        the by columns and optionally period. Columns are matched from
+        trips, panelists and products by sorted-index lookups.
+        Returns (table, panelist-level by columns).
+        """
+        if isinstance(self.df_products, pa.Table):
+            product_cols = self.df_products.column_names
+        elif isinstance(self.df_products, pd.DataFrame):
+            product_cols = list(self.df_products.columns)
+        else:
+            product_cols = []
+
+        pan_by = [c for c in by if c in df_panelists.column_names
+                  and c not in df_purchases.column_names]
+        trip_by = [c for c in by if c in df_trips.column_names
+                   and c not in df_purchases.column_names + pan_by]
+        prod_by = [c for c in by if c in product_cols
+                   and c not in df_purchases.column_names + pan_by + trip_by]
+        missing = set(by) - set(df_purchases.column_names + pan_by + trip_by + prod_by)
+        if missing:
+            raise ValueError(f'Cannot group on unknown columns: {missing}')
+
+        trips = _SortedIndex(df_trips, 'trip_code_uc',
+                             ['household_code', 'purchase_date'] + trip_by)
+        panelists = _SortedIndex(df_panelists, 'household_code', [weight] + pan_by)
+
+        trip_idx = trips.positions(df_purchases['trip_code_uc'])
+        households = trips.table['household_code'].take(trip_idx)
+        pan_idx = panelists.positions(households)
+
+        cols = {'panel_year': pa.array(np.full(df_purchases.num_rows, year, np.uint16)),
+                'household_code': households,
+                'trip_code_uc': df_purchases['trip_code_uc'],
+                'weight': pc.cast(panelists.table[weight].take(pan_idx), pa.float64()),
+                'spend': pc.subtract(pc.cast(df_purchases['total_price_paid'], pa.float64()),
+                                     pc.fill_null(pc.cast(df_purchases['coupon_value'], pa.float64()), 0.0)),
+                'quantity': pc.cast(df_purchases['quantity'], pa.float64())}
+        for c in by:
+            if c in df_purchases.column_names:
+                cols[c] = df_purchases[c]
+            elif c in pan_by:
+                cols[c] = panelists.table[c].take(pan_idx)
+            elif c in trip_by:
+                cols[c] = trips.table[c].take(trip_idx)
+        if prod_by:
+            prod_index = self._product_index()
+            prod_idx = prod_index.positions(_composite_key(
+                df_purchases['upc'].to_numpy(), df_purchases['upc_ver_uc'].to_numpy()))
+            for c in prod_by:
+                cols[c] = prod_index.table[c].take(prod_idx)
+        if period:
+            dates = pc.cast(trips.table['purchase_date'].take(trip_idx), pa.date32())
+            cols['period'] = pc.floor_temporal(dates, unit = period,
+                                               week_starts_monday = False)
+
+        # drop purchases of households that are not in the panelist file
+        df = pa.table(cols)
+        return df.filter(pc.is_valid(df['weight'])), pan_by
+
+    def aggregate_purchases(self, by = ('product_module_code',), period = None,
+                            weight = 'Projection_Factor', **kwargs):
+        """
+        Function: projection-weighted expenditure, quantity and household
+        penetration by panel_year and a chosen grain
+
+        Arguments:
+            by: columns to group on, taken from df_products
+                (e.g. product_module_code, brand_code_uc), df_panelists
+                (e.g. DMA_Cd, Fips_State_Desc) or df_trips (e.g. retailer_code)
+            period: None, 'week', 'month' or 'quarter': adds a period column
+                with the first day of the period of purchase_date
+                (weeks start on Sunday)
+            weight: panelist weight column (default: Projection_Factor)
+            kwargs: filters passed to read_year (keep_states, keep_dmas, ...)
+                if read_annual has not been run
+
+        Works one year at a time: purchases are matched to trips, panelists
+        and products by sorted-index lookups on just the needed columns,
+        so the full purchase-level join is never built.
+        If read_products() was run, product columns are available in by.
+
+        Returns a pyarrow Table with one row per panel_year x grain:
+            spend: total_price_paid net of coupon_value
+            quantity, trips, households: unweighted totals
+            projected_spend, projected_quantity, projected_trips,
+            projected_households: Projection_Factor-weighted totals
+            projected_universe: weighted households in the panel
+                (within any panelist-level grain columns)
+            penetration: projected_households / projected_universe
+        """
+        by = [by] if isinstance(by, str) else list(by)
+        keys = ['panel_year'] + by + (['period'] if period else [])
+
+        results = []
+        for year, df_panelists, df_trips, df_purchases in self._iter_years(**kwargs):
+            df, pan_by = self._purchase_frame(year, df_panelists, df_trips,
+                                              df_purchases, by, period, weight)
+
+            # first collapse to household x grain, then weight and collapse
+            df_hh = df.group_by(keys + ['household_code']).aggregate(
+                [('spend', 'sum'), ('quantity', 'sum'),
+                 ('trip_code_uc', 'count_distinct'), ('weight', 'max')])
+            w = df_hh['weight_max']
+            df_hh = pa.table({**{k: df_hh[k] for k in keys},
+                              'household_code': df_hh['household_code'],
+                              'spend': df_hh['spend_sum'],
+                              'quantity': df_hh['quantity_sum'],
+                              'trips': df_hh['trip_code_uc_count_distinct'],
+                              'projected_spend': pc.multiply(w, df_hh['spend_sum']),
+                              'projected_quantity': pc.multiply(w, df_hh['quantity_sum']),
+                              'projected_trips': pc.multiply(w, df_hh['trip_code_uc_count_distinct']),
+                              'projected_households': w})
+            df_y = df_hh.group_by(keys).aggregate(
+                [(c, 'sum') for c in ['spend', 'quantity', 'trips', 'projected_spend',
+                                      'projected_quantity', 'projected_trips',
+                                      'projected_households']]
+                + [('household_code', 'count')])
+            df_y = df_y.rename_columns([c[:-len('_sum')] if c.endswith('_sum')
+                                        else 'households' if c == 'household_code_count'
+                                        else c for c in df_y.column_names])
+
+            # penetration: share of the projected panel universe
+            universe_by = pan_by
+            df_universe = df_panelists.filter(pc.greater(df_panelists[weight], 0))
+            if universe_by:
+                df_universe = df_universe.group_by(universe_by).aggregate([(weight, 'sum')])
+                df_universe = df_universe.rename_columns(
+                    universe_by + ['projected_universe'])
+                df_universe = df_universe.set_column(
+                    len(universe_by), 'projected_universe',
+                    pc.cast(df_universe['projected_universe'], pa.float64()))
+                df_y = df_y.join(df_universe, keys = universe_by, join_type = 'left outer')
+            else:
+                total = pc.sum(pc.cast(df_universe[weight], pa.float64())).as_py() or 0.0
+                df_y = df_y.append_column('projected_universe',
+                                          pa.array(np.full(df_y.num_rows, total)))
+            df_y = df_y.append_column('penetration',
+                                      pc.divide(df_y['projected_households'],
+                                                df_y['projected_universe']))
+            results.append(df_y)
+
+        df_out = pa.concat_tables(results, promote_options='default')
+        return df_out.sort_by([(k, 'ascending') for k in keys])
+
+    def purchase_matrix(self, by = 'product_module_code', period = 'week', **kwargs):
+        """
+        Function: builds sparse household-period x product spend and
+        quantity matrices
+
+        Arguments:
+            by: product column for the matrix columns, e.g.
+                product_module_code or brand_code_uc (needs read_products())
+                or upc
+            period: 'week', 'month', 'quarter' or None (one row per household)
+            kwargs: filters passed to read_year if read_annual has not been run
+
+        Each year is collapsed to household x period x product before
+        moving on, so only the non-zero entries are kept in memory.
+
+        Returns a PurchaseMatrix with COO arrays (row, col, spend,
+        quantity), row_labels (household_code, period) and col_labels.
+        """
+        parts = []
+        for year, df_panelists, df_trips, df_purchases in self._iter_years(**kwargs):
+            df, _ = self._purchase_frame(year, df_panelists, df_trips,
+                                         df_purchases, [by], period)
+            df = df.filter(pc.is_valid(df[by]))
+            keys = ['household_code'] + (['period'] if period else []) + [by]
+            parts.append(df.group_by(keys).aggregate(
+                [('spend', 'sum'), ('quantity', 'sum')]))
+
+        df = pa.concat_tables(parts).combine_chunks()
+
+        # integer-code rows on (household_code, period) and columns on by
+        households = df['household_code'].to_numpy()
+        if period:
+            days = pc.cast(df['period'], pa.int32()).to_numpy()
+        else:
+            days = np.zeros(df.num_rows, dtype=np.int32)
+        row_keys, row = np.unique(_composite_key(households, days, bits=32),
+                                  return_inverse=True)
+        col_labels, col = np.unique(df[by].to_numpy(), return_inverse=True)
+
+        row_labels = {'household_code': pa.array(row_keys >> np.uint64(32), pa.uint32())}
+        if period:
+            row_labels['period'] = pa.array(
+                (row_keys & np.uint64(0xFFFFFFFF)).astype(np.int32)).cast(pa.date32())
+
+        order = np.lexsort((col, row))
+        return PurchaseMatrix(row[order].astype(np.int32),
+                              col[order].astype(np.int32),
+                              df['spend_sum'].to_numpy()[order],
+                              df['quantity_sum'].to_numpy()[order],
+                              pa.table(row_labels),
+                              pa.array(col_labels, df[by].type))
+
+    def link_scanner_prices(self, sales, columns = None, store_chunk = 500):
+        """
+        Function: attaches store-week scanner prices and promotion flags to
+        df_purchases, matched on (store_code_uc, week_end, upc)
+
+        Arguments:
+            sales: a RetailReader, its df_sales table, or the path of a
+                parquet file or dataset written by RetailReader.write_data
+            columns: scanner columns to attach
+                (default: price, prmult, unit_price, feature, display,
+                 whichever are present)
+            store_chunk: number of panel stores joined at a time
+
+        Purchases are sorted by store once, and the join runs one chunk of
+        stores at a time: for each chunk only the sales rows for those
+        stores and the chunk's week range are read (pushed down to the
+        parquet scan), so memory is bounded by the largest chunk.
+        store_code_uc and week_end are taken from df_purchases if present
+        (read_annual(add_trip_info=True, add_dates=True)), otherwise
+        looked up from df_trips.
+
+        After read_annual(sink=...), the sink is scanned one year partition
+        at a time and the linked years are concatenated.
+
+        Returns df_purchases (in its original order) with the scanner
+        columns appended; unmatched purchases get nulls.
+        """
+        if isinstance(sales, RetailReader):
+            sales = sales.df_sales
+        if isinstance(sales, pa.Table):
+            ds_sales = pads.dataset(sales)
+        else:
+            ds_sales = pads.dataset(sales, format = 'parquet', partitioning = 'hive')
+        sales_cols = ds_sales.schema.names
+        if columns is None:
+            columns = [c for c in ['price', 'prmult', 'unit_price', 'feature', 'display']
+                       if c in sales_cols]
+
+        if isinstance(self.df_purchases, pads.Dataset):
+            parts = [self._link_prices(df_purchases, df_trips, ds_sales, columns, store_chunk)
+                     for _, _, df_trips, df_purchases in self._iter_years()]
+            df_purchases = pa.concat_tables([df for df, _ in parts])
+            n_matched = sum(n for _, n in parts)
+        elif isinstance(self.df_purchases, pa.Table):
+            df_purchases, n_matched = self._link_prices(self.df_purchases, self.df_trips,
+                                                        ds_sales, columns, store_chunk)
+        else:
+            raise ValueError('Run read_annual() before linking scanner prices')
+
+        if self.verbose:
+            print('Matched scanner prices for', n_matched, 'of',
+                  df_purchases.num_rows, 'purchases')
+        return df_purchases
+
+    def _link_prices(self, df_purchases, df_trips, ds_sales, columns, store_chunk):
+        """
+        Attach the scanner columns of ds_sales to df_purchases
+        (see link_scanner_prices), looking up stores and weeks in df_trips
+        if needed. Returns the linked table and the number of matches.
+        """
+        week_type = ds_sales.schema.field('week_end').type
+        store_type = ds_sales.schema.field('store_code_uc').type
+
+        # purchase-side keys, taken from trips if not already attached
+        stores = df_purchases['store_code_uc'] if 'store_code_uc' in df_purchases.column_names else None
+        weeks = df_purchases['week_end'] if 'week_end' in df_purchases.column_names else None
+        if stores is None or weeks is None:
+            trips = _SortedIndex(df_trips, 'trip_code_uc',
+                                 ['store_code_uc', 'purchase_date', 'week_end'])
+            trip_idx = trips.positions(df_purchases['trip_code_uc'])
+            if stores is None:
+                stores = trips.table['store_code_uc'].take(trip_idx)
+            if weeks is None:
+                if 'week_end' in trips.table.column_names:
+                    weeks = trips.table['week_end'].take(trip_idx)
+                else:
+                    weeks = _calendar_columns(_parse_dates(
+                        trips.table['purchase_date'].take(trip_idx)))['week_end']
+        keys = pa.table({'__row': pa.array(np.arange(df_purchases.num_rows)),
+                         'store_code_uc': pc.cast(stores, store_type),
+                         'week_end': pc.cast(weeks, week_type),
+                         'upc': df_purchases['upc']})
+        keys = keys.filter(pc.and_(pc.is_valid(keys['store_code_uc']),
+                                   pc.is_valid(keys['week_end'])))
+
+        # sort purchases by store, week once and walk through store chunks
+        keys = keys.sort_by([('store_code_uc', 'ascending'), ('week_end', 'ascending')])
+        store_values = keys['store_code_uc'].to_numpy()
+        unique_stores = np.unique(store_values)
+
+        parts = []
+        for i in range(0, len(unique_stores), store_chunk):
+            chunk = unique_stores[i:i + store_chunk]
+            lo = np.searchsorted(store_values, chunk[0], side = 'left')
+            hi = np.searchsorted(store_values, chunk[-1], side = 'right')
+            df_keys = keys.slice(lo, hi - lo)
+            week_min = pc.min(df_keys['week_end'])
+            week_max = pc.max(df_keys['week_end'])
+            sales_filter = (pads.field('store_code_uc').isin(pa.array(chunk, store_type)) &
+                            (pads.field('week_end') >= week_min) &
+                            (pads.field('week_end') <= week_max))
+            df_sales = ds_sales.to_table(columns = ['store_code_uc', 'week_end', 'upc'] + columns,
+                                         filter = sales_filter)
+            matched = df_keys.join(df_sales, keys = ['store_code_uc', 'week_end', 'upc'],
+                                   join_type = 'inner')
+            parts.append(matched.select(['__row'] + columns))
+
+        if parts:
+            matched = pa.concat_tables(parts)
+        else:
+            matched = pa.table({'__row': pa.array([], pa.int64()),
+                                **{c: pa.array([], ds_sales.schema.field(c).type) for c in columns}})
+
+        # scatter matched scanner rows back to purchase order
+        pos = np.full(df_purchases.num_rows, -1, dtype = np.int64)
+        pos[matched['__row'].to_numpy()] = np.arange(matched.num_rows)
+        idx = pa.array(pos, mask = pos < 0)
+        for col in columns:
+            df_purchases = df_purchases.append_column(col, matched[col].take(idx))
+        return df_purchases, matched.num_rows
+
+    def _worker_copy(self):
+        """
+        Copy of the reader for process pool workers, sent once per worker
+        (see _init_worker): the file lists and settings, and of the tables
+        only the product UPC set that read_year filters purchases on.
+        """
+        reader = copy.copy(self)
+        reader._upc_set = self._product_upc_set()
+        # None is None: _product_upc_set keeps returning the set above
+        reader.df_products = reader._upc_set_source = None
+        reader._product_index_source = reader._product_index_cache = None
+        for name in ('df_panelists', 'df_trips', 'df_purchases'):
+            setattr(reader, name, [])
+        for name in ('df_variations', 'df_retailers', 'df_extra'):
+            setattr(reader, name, pd.DataFrame())
+        reader.stats = ReaderStats()
+        reader.progress = None
+        return reader
+
+    def _read_years_to_sink(self, years, year_kwargs, sink, stub = 'out',
+                            compr = 'brotli', max_workers = None):
+        """
+        Read each year and write it to sink right away (see read_annual),
+        in a process pool if max_workers > 1. Only the schemas are kept;
+        the tables are replaced by lazy datasets over the sink.
+        """
+        sink = path.Path(sink)
+        names = ('panelists', 'trips', 'purchases')
+        for name in names:
+            shutil.rmtree(sink / '{stub}_{n}'.format(stub=stub, n=name), ignore_errors = True)
+
+        results = []
+        if max_workers is not None and max_workers > 1:
+            print('Processing Years', years, 'with', max_workers, 'workers')
+            t_start = time.perf_counter()
+            with ProcessPoolExecutor(max_workers = max_workers, initializer = _init_worker,
+                                     initargs = (self._worker_copy(),)) as pool:
+                futures = [pool.submit(_sink_year_worker, year, sink,
+                                       stub, compr, year_kwargs)
+                           for year in years]
+                for year, future in zip(years, futures):
+                    schemas, spans = future.result()
+                    results.append(schemas)
+                    self.stats.extend(spans)
+                    if self.verbose:
+                        print('Finished Year', year)
+                    self._progress_year(year)
+            _print_elapsed(time.perf_counter() - t_start)
+        else:
+            for year in years:
+                print('Processing Year', year)
+                t_year = time.perf_counter()
+                df_panelists, df_trips, df_purchases = self._read_year_tables(year, **year_kwargs)
+                results.append(_sink_year({'panelists': df_panelists, 'trips': df_trips,
+                                           'purchases': df_purchases},
+                                          year, sink, stub, compr, self.stats))
+                # drop this year's tables before reading the next
+                del df_panelists, df_trips, df_purchases
+                _print_elapsed(time.perf_counter() - t_year)
+                self._progress_year(year)
+
+        for name in names:
+            dir_table = sink / '{stub}_{n}'.format(stub=stub, n=name)
+            schema = _unify_schemas([r[name][0] for r in results])
+            schema = schema.append(pa.field('panel_year', results[0][name][1]))
+            pq.write_metadata(schema, dir_table / '_common_metadata')
+            setattr(self, 'df_' + name, _sink_dataset(dir_table, schema))
+        if self.verbose:
+            print('Wrote panelists, trips and purchases by year to', sink)
+        return
+
+    def _read_years_parallel(self, years, year_kwargs, max_workers):
+        """
+        Run read_year for each year in a process pool and append the
+        results to df_panelists, df_trips and df_purchases in year order
+        """
+        print('Processing Years', years, 'with', max_workers, 'workers')
+        t_start = time.perf_counter()
+        with tempfile.TemporaryDirectory() as dir_tmp:
+            with ProcessPoolExecutor(max_workers = max_workers, initializer = _init_worker,
+                                     initargs = (self._worker_copy(),)) as pool:
+                futures = [pool.submit(_read_year_worker, year,
+                                       dir_tmp, year_kwargs)
+                           for year in years]
+                for year, future in zip(years, futures):
+                    files, spans = future.result()
+                    self.stats.extend(spans)
+                    self.df_panelists.append(_read_ipc(files['df_panelists']))
+                    self.df_trips.append(_read_ipc(files['df_trips']))
+                    self.df_purchases.append(_read_ipc(files['df_purchases']))
+                    if self.verbose:
+                        print('Finished Year', year)
+                    self._progress_year(year)
+        _print_elapsed(time.perf_counter() - t_start)
+        return
+
     def write_data(self, dir_write = path.Path.cwd(), stub = 'out',
                    compr = 'brotli', as_table = False,
-                   separator = 'panel_year'):
+                   separator = 'panel_year', by_household = False,
+                   row_group_size = 1000000, max_workers = None,
+                   format = 'parquet'):
         """
         Function: writes pandas dataframes to parquets
         Arguments
@@ -1590,7 +4529,33 @@ class PanelReader(object):
         since the separator for now must be common to all files
         
         Always saves as parquets with compression of your choice
-        (default: brotli)
+        (default: brotli), either a codec name or one of the
+        COMPRESSION_PROFILES ('fast', 'balanced', 'archive')
+
+        as_table: if True, each table is sorted once by the separator and
+        written as runs of row groups of at most row_group_size rows, one
+        run per separator value; the file metadata records which row groups
+        hold each value, so load_separated() reads a single year directly.
+
+        by_household: if True, purchases are sorted by household_code
+        (attached from trips if needed) and panel_year and written in row
+        groups of row_group_size rows, along with a sidecar index
+        [stub]_purchases_households.parquet mapping each household and
+        year to its row group and row range. Use load_households() to read
+        the purchases of selected households back.
+
+        max_workers: if > 1, write the tables concurrently in a thread pool
+        of this size
+
+        format: 'parquet' (default) or 'ipc', which writes each table to an
+        Arrow IPC file [stub]_[table].arrow for a fast reload with
+        PanelReader.load(); compr is then 'lz4' or 'zstd', anything else
+        writes uncompressed files that load without copying, and the other
+        layout options are ignored
+
+        After read_annual(sink=...), the sink datasets are streamed out one
+        year partition at a time in every layout (as_table then requires
+        separator = 'panel_year'; by_household sorts within each year).
         """
 
         # most important: define a writing directory
@@ -1599,6 +4564,15 @@ class PanelReader(object):
     
         if self.verbose == True:
             print('Writing to', dir_write)
+
+        if format == 'ipc':
+            _run_writes([(aux_write_ipc, (getattr(self, 'df_' + name),
+                                          path.Path(dir_write) / '{stub}_{n}.arrow'.format(stub=stub, n=name),
+                                          compr))
+                         for name in self.OUTPUT_TABLES], max_workers, self.stats)
+            return
+        elif format != 'parquet':
+            raise ValueError("format must be 'parquet' or 'ipc'")
     
         f_products = self.dir_write / '{stub}_products.parquet'.format(stub=stub)
         f_variations = self.dir_write /'{stub}_variations.parquet'.format(stub=stub)
@@ -1610,28 +4584,73 @@ class PanelReader(object):
 
         print(dir_write)
 
+        # purchases are the largest table: queue them first
+        jobs = []
+        df_purchases = self.df_purchases
+
+        def aux_sink_parts(ds_purchases):
+            # read_annual(sink=...): one year partition at a time,
+            # with household_code from that year's trips if needed
+            for year in _dataset_years(ds_purchases):
+                expr = pc.field('panel_year') == year
+                df = ds_purchases.to_table(filter = expr)
+                if 'household_code' not in df.column_names:
+                    trips = self.df_trips.to_table(columns = ['trip_code_uc', 'household_code'],
+                                                   filter = expr)
+                    df = _SortedIndex(trips, 'trip_code_uc', ['household_code']
+                                      ).enrich(df, ['household_code'])
+                yield df
+
+        if by_household and (isinstance(df_purchases, pads.Dataset) or
+                             isinstance(df_purchases, pa.Table) and df_purchases.num_rows > 0):
+            if isinstance(df_purchases, pads.Dataset):
+                df_purchases = aux_sink_parts(df_purchases)
+            elif 'household_code' not in df_purchases.column_names:
+                df_purchases = _SortedIndex(self.df_trips, 'trip_code_uc', ['household_code']
+                                            ).enrich(df_purchases, ['household_code'])
+            f_index = self.dir_write / '{stub}_purchases_households.parquet'.format(stub=stub)
+
+            def aux_write_households(df):
+                _write_household_sorted(df, f_purchases, f_index,
+                                        compr = compr, row_group_size = row_group_size)
+                if self.verbose:
+                    print('Wrote purchases sorted by household to', f_purchases,
+                          'with index', f_index)
+
+            jobs.append((aux_write_households, (df_purchases,)))
+            # purchases are done: skip them below
+            df_purchases = None
+
         if as_table == False:
-            aux_write_direct(self.df_products, f_products)
-            aux_write_direct(self.df_variations, f_variations)
-            aux_write_direct(self.df_retailers, f_retailers)
-            aux_write_direct(self.df_extra, f_extra)
-
-            aux_write_direct(self.df_trips, f_trips)
-            aux_write_direct(self.df_panelists, f_panelists)
-            aux_write_direct(self.df_purchases, f_purchases)
+            if df_purchases is not None:
+                jobs.append((aux_write_direct, (df_purchases, f_purchases, compr)))
+            jobs += [(aux_write_direct, (self.df_trips, f_trips, compr)),
+                     (aux_write_direct, (self.df_panelists, f_panelists, compr)),
+                     (aux_write_direct, (self.df_products, f_products, compr)),
+                     (aux_write_direct, (self.df_variations, f_variations, compr)),
+                     (aux_write_direct, (self.df_retailers, f_retailers, compr)),
+                     (aux_write_direct, (self.df_extra, f_extra, compr))]
+            _run_writes(jobs, max_workers, self.stats)
     
             return # end the job right here
     
     
-        def aux_write_separated(df, filename, separator = 'panel_year',
-                            compr = 'brotli'):
+        def aux_write_separated(df, filename):
             # Convert pandas to Arrow if needed
             if isinstance(df, pd.DataFrame):
                 if df.empty:
                     return
                 df = pa.Table.from_pandas(df, preserve_index=False)
 
-            if isinstance(df, pa.Table):
+            if isinstance(df, pads.Dataset):
+                # read_annual(sink=...): already split by year on disk
+                if separator != 'panel_year':
+                    raise ValueError('Tables read with read_annual(sink=...) can only be '
+                                     "written with separator = 'panel_year'")
+                if df.count_rows() == 0:
+                    return
+                col_names = df.schema.names
+            elif isinstance(df, pa.Table):
                 if df.num_rows == 0:
                     return
                 col_names = df.column_names
@@ -1644,16 +4663,9 @@ class PanelReader(object):
                 aux_write_direct(df, filename, compr)
                 return
 
-            # Write row groups separated by the separator column
-            seps = pc.unique(df[separator]).to_pylist()
-            table0 = df.filter(pc.equal(df[separator], seps[0]))
-            writer = pq.ParquetWriter(filename, table0.schema,
-                                      compression = compr)
-            writer.write_table(table0)
-            for sep_val in seps[1:]:
-                table_part = df.filter(pc.equal(df[separator], sep_val))
-                writer.write_table(table_part)
-            writer.close()
+            # sort once by the separator and write capped row groups
+            _write_separated(df, filename, separator, compr = compr,
+                             row_group_size = row_group_size)
 
             if self.verbose:
                 print('Wrote Data to {f} with row groups by {sep}'.format(
@@ -1663,13 +4675,15 @@ class PanelReader(object):
     
         # can separate out the files and write them as pyarrow tables
         # create separate dataframes and avoid overwhelming your system, i guess
-        aux_write_separated(self.df_products, f_products)
-        aux_write_separated(self.df_variations, f_variations)
-        aux_write_separated(self.df_retailers, f_retailers)
-        aux_write_separated(self.df_trips, f_trips)
-        aux_write_separated(self.df_panelists, f_panelists)
-        aux_write_separated(self.df_purchases, f_purchases)
-        aux_write_separated(self.df_extra, f_extra)
+        if df_purchases is not None:
+            jobs.append((aux_write_separated, (df_purchases, f_purchases)))
+        jobs += [(aux_write_separated, (self.df_trips, f_trips)),
+                 (aux_write_separated, (self.df_panelists, f_panelists)),
+                 (aux_write_separated, (self.df_products, f_products)),
+                 (aux_write_separated, (self.df_variations, f_variations)),
+                 (aux_write_separated, (self.df_retailers, f_retailers)),
+                 (aux_write_separated, (self.df_extra, f_extra))]
+        _run_writes(jobs, max_workers, self.stats)
 
     # Revised Panelist Files
     # Updates the usual Panel files with the revisions
@@ -1680,6 +4694,10 @@ class PanelReader(object):
 
         Must have already run the read_annual() function so that df_panelists
         is not an empty dataframe
+
+        Revisions are applied as keyed patches (see REVISION_KEYS): rows
+        whose keys appear in a revision file get the revised non-null
+        values, all other rows and columns are left untouched.
         """
 
         self.files_revised = [f for f in self.files if
@@ -1695,71 +4713,76 @@ class PanelReader(object):
                                        f for f in self.files_panelist_revised
                                        }
 
-        # Convert Arrow tables to pandas for .update() compatibility
-        # then convert back at the end
-        if isinstance(self.df_panelists, pa.Table):
-            self.df_panelists = self.df_panelists.to_pandas()
-        if isinstance(self.df_products, pa.Table):
-            self.df_products = self.df_products.to_pandas()
-        if isinstance(self.df_variations, pa.Table):
-            self.df_variations = self.df_variations.to_pandas()
-        if isinstance(self.df_retailers, pa.Table):
-            self.df_retailers = self.df_retailers.to_pandas()
+        parse_opt = csv.ParseOptions(delimiter = '\t')
+        conv_opt = csv.ConvertOptions(column_types = dict_types)
+        # some revision files contain stray quotes: read with quoting off
+        parse_opt_noquote = csv.ParseOptions(delimiter = '\t', quote_char = False)
 
+        def aux_read_revision(filename, parse_options = parse_opt):
+            df_rev = _read_csv(self, filename,
+                               parse_options = parse_options,
+                               convert_options = conv_opt)
+            col_names = [COLUMN_RENAME_MAP.get(x, x) for x in df_rev.column_names]
+            return df_rev.rename_columns(col_names)
+
+        # panelists: patch rows by (household_code, panel_year)
         for year in self.all_years:
-            df_panelist_rev = pd.read_csv(dict_files_panelist_revised[year],
-                                          delimiter = '\t')
-            self.df_panelists.update(df_panelist_rev)
+            if year in dict_files_panelist_revised:
+                self.df_panelists = _keyed_upsert(
+                    self.df_panelists,
+                    aux_read_revision(dict_files_panelist_revised[year]),
+                    REVISION_KEYS['panelists'])
 
         # update the other files (if they are empty, they will stay empty)
         self.file_product_revised = [f for f in self.files_revised if
                                      'products' in f.name]
-        df_products_rev = pd.read_csv(self.file_product_revised[0],
-                                      delimiter = '\t')
-        self.df_products.update(df_products_rev)
+        if self.file_product_revised:
+            self.df_products = _keyed_upsert(
+                self.df_products,
+                aux_read_revision(self.file_product_revised[0]),
+                REVISION_KEYS['products'])
 
         # variations
         self.file_variations_revised = [f for f in self.files_revised if
                                         'brand_variations' in f.name]
-        df_variations_rev = pd.read_csv(self.file_variations_revised[0],
-                                        delimiter = '\t',
-                                        engine = 'python',
-                                        encoding = 'utf',
-                                        quoting=3)
-        self.df_variations.update(df_variations_rev)
+        if self.file_variations_revised:
+            self.df_variations = _keyed_upsert(
+                self.df_variations,
+                aux_read_revision(self.file_variations_revised[0], parse_opt_noquote),
+                REVISION_KEYS['variations'])
 
         # retailers
         self.file_retailers_revised = [f for f in self.files_revised if
                                      'retailers' in f.name]
-        df_retailers_rev = pd.read_csv(self.file_retailers_revised[0],
-                                       delimiter = '\t',
-                                       engine = 'python',
-                                       encoding = 'utf',
-                                       quoting=3)
-        self.df_retailers.update(df_retailers_rev)
-
-        # Convert back to Arrow tables
-        self.df_panelists = pa.Table.from_pandas(self.df_panelists, preserve_index=False)
-        self.df_products = pa.Table.from_pandas(self.df_products, preserve_index=False)
-        self.df_variations = pa.Table.from_pandas(self.df_variations, preserve_index=False)
-        self.df_retailers = pa.Table.from_pandas(self.df_retailers, preserve_index=False)
+        if self.file_retailers_revised:
+            self.df_retailers = _keyed_upsert(
+                self.df_retailers,
+                aux_read_revision(self.file_retailers_revised[0], parse_opt_noquote),
+                REVISION_KEYS['retailers'])
 
         return
 
     # Look through open issues
-    # Currently somehwat ad-hoc: can fix the Flavor Code + Male Birth Month
-    # Will have to udpate as issues close and open
+    # Fixes are declared in OPEN_ISSUE_PATCHES; add a spec there as issues
+    # open and remove it as they close
 
-    def process_open_issues(self):
+    def process_open_issues(self, patches = None):
         """
-        Function: addresses two of the current (as of 10/01/2021) open issues
+        Function: addresses the current (as of 10/01/2021) open issues
         in Nielsen Panel data
         Issue 1: Flavor Code in 2010 missing
         Issue 2: Male Head Birth Month incorrect
         See documentation within Panel files for a description of the issues
 
         Affected files: df_extra, df_panelists
+
+        Optional: patches: list of patch specs (default: OPEN_ISSUE_PATCHES).
+        Each spec names the open-issue folder, the target table, a file
+        name pattern, key columns and column transforms; all files of a
+        spec are read with Arrow and applied in one keyed patch.
         """
+        if patches is None:
+            patches = OPEN_ISSUE_PATCHES
 
         self.files_issues = [f for f in self.files if
                             'OpenIssues_SupplementFiles' in f.parts]
@@ -1768,50 +4791,41 @@ class PanelReader(object):
 
         print('Current Open Issues:', self.open_issues)
 
-        # Convert Arrow tables to pandas for update/merge compatibility
-        if isinstance(self.df_extra, pa.Table):
-            self.df_extra = self.df_extra.to_pandas()
-        if isinstance(self.df_panelists, pa.Table):
-            self.df_panelists = self.df_panelists.to_pandas()
-
-        # First, Address the ExtraAttributesFlavorCode
-        if 'ExtraAttributes_FlavorCode' in self.open_issues:
-            self.flavor_csv = [f for f in self.files_issues if
-                               f.name == 'Latest_Flavor_2010.csv']
-
-            df_flavor = pd.read_csv(self.flavor_csv[0], delimiter = '\t')
-            self.df_extra.update(df_flavor)
-
-        # Then, Address the Panelist Birth Years
-        if 'Panelist_maleHeadBirth_femaleHeadBirth' in self.open_issues:
-            files_birth = [f for f in self.files_issues
-                           if f.parent.name ==
-                           'Panelist_maleHeadBirth_femaleHeadBirth']
-            dict_files_birth = {2000+int(f.name[6:8]): f for f in files_birth}
-            dict_files_birth = {k: dict_files_birth[k]
-                                for k in dict_files_birth.keys()
-                                if k in self.all_years }
-
-            for f in dict_files_birth:
-                f_ann = pd.read_csv(dict_files_birth[f],
-                                    delimiter = '\t')
-                f_ann.columns = ['household_code',
-                                 'panel_year',
-                                 'Male_Head_Birth',
-                                 'Female_Head_Birth'
-                                 ]
-                f_ann['Female_Head_Birth'] = f_ann['Female_Head_Birth'].replace('-', np.nan)
-                f_ann['Male_Head_Birth'] = f_ann['Male_Head_Birth'].replace('-', np.nan)
+        parse_opt = csv.ParseOptions(delimiter = '\t')
+        conv_opt = csv.ConvertOptions(column_types = dict_types)
 
-                f_ann['Male_Head_Birth'] = (f_ann['Male_Head_Birth'].str[:4].fillna(-1)).astype(int)
-                f_ann['Female_Head_Birth'] = (f_ann['Female_Head_Birth'].str[:4].fillna(-1)).astype(int)
+        for spec in patches:
+            if spec['issue'] not in self.open_issues:
+                continue
+            target = getattr(self, spec['target'])
+            if not isinstance(target, pa.Table) or target.num_rows == 0:
+                continue
 
-                self.df_panelists = self.df_panelists.merge(
-                    f_ann, on = ['panel_year', 'household_code'],
-                    suffixes = ('', '_revised'),
-                    how = 'left')
+            files = [f for f in self.files_issues
+                     if f.parent.name == spec['issue']
+                     and fnmatch.fnmatch(f.name, spec.get('pattern', '*'))]
+            year_func = spec.get('year')
+            if year_func is not None:
+                files = [f for f in files if year_func(f) in self.all_years]
+            if not files:
+                continue
 
-        # Convert back to Arrow tables
-        self.df_extra = pa.Table.from_pandas(self.df_extra, preserve_index=False)
-        self.df_panelists = pa.Table.from_pandas(self.df_panelists, preserve_index=False)
+            def aux_read_patch(f):
+                df = _read_csv(self, f, parse_options = parse_opt,
+                               convert_options = conv_opt)
+                if spec.get('names'):
+                    df = df.rename_columns(spec['names'])
+                if year_func is not None and 'panel_year' not in df.column_names:
+                    df = df.append_column('panel_year',
+                        pa.array(np.full(df.num_rows, year_func(f), np.uint16)))
+                for col, func in spec.get('transforms', {}).items():
+                    df = df.set_column(df.column_names.index(col), col, func(df[col]))
+                return df
+
+            df_patch = pa.concat_tables([aux_read_patch(f) for f in files],
+                                        promote_options = 'permissive')
+            setattr(self, spec['target'],
+                    _keyed_upsert(target, df_patch, spec['keys'],
+                                  suffix = spec.get('suffix')))
 
+        return